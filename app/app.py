@@ -1,8 +1,13 @@
-import json, traceback, time
-import pymysql
+import os, json, traceback, threading
+import storage
 from flask import Flask
 from flask import request
 import getter
+import engine
+import dbpool
+import dbversion
+import cache
+import zipindex
 import conf
 
 app = Flask(__name__)
@@ -14,58 +19,226 @@ file_logging_handler.setLevel(logging.INFO)
 file_logging_handler.setLevel(logging.DEBUG)
 app.logger.addHandler(file_logging_handler)
 
-dbconn = None
+# Номер текущей версии БД
+version_tracker = dbversion.VersionTracker(conf.version_ttl, conf.version_file)
 
-def connect_to_mysql():
-    """Connects to MySQL and returns the connection."""
-    return pymysql.connect(host=conf.db_host, user=conf.db_user,
-        passwd=conf.db_password, db=conf.db_name, port=conf.db_port,
-        charset='utf8')
+# Загруженный в память движок (для conf.use_memory_engine) и версия
+# БД, движок которой загружается в фоновом потоке
+memory_engine = None
+memory_engine_loading = None
+memory_engine_lock = threading.Lock()
 
-# Пытаемся приконнектиться в течение 10 секунд
-for i in range(0, 10, 1):
-    try:
-        dbconn = connect_to_mysql()
-        break
-    except pymysql.err.OperationalError as err:
-        # если ошибка "Can't connect to MySQL server..."
-        if err.args[0] == 2003:
-            print(traceback.format_exc())
-            time.sleep(1)
-        else:
-            raise
-
-if dbconn is None:
-    app.logger.error('Could not connect to MySQL server. Exiting...')
+# Файл индекса почтовых индексов (для conf.use_zip_index) и версия БД,
+# для которой он открыт (или для которой файла нет)
+zip_index = None
+zip_index_version = None
+zip_index_lock = threading.Lock()
+
+# Кэш ответов
+response_cache = cache.ResponseCache(conf.cache_max_items,
+    conf.cache_max_bytes, conf.cache_ttl)
+
+# Сериализованный ответ для незаполненной формы: (версия БД, ответ)
+initial_response = (None, None)
+
+def connect_to_db():
+    """Connects to the DB (MySQL or SQLite, see conf.db_engine) and
+    returns the connection."""
+    # autocommit нужен, чтобы долгоживущие соединения видели
+    # изменения таблицы OPTIONS после обновления БД
+    return storage.connect(autocommit=True)
+
+# Пул соединений с БД
+db_pool = dbpool.ConnectionPool(connect_to_db, conf.db_pool_size,
+    conf.db_pool_max_idle_time, conf.db_connect_retries,
+    check_interval=conf.db_pool_check_interval)
+
+# Проверяем, что БД доступна. Проверочное соединение закрывается:
+# модуль загружается в мастер-процессе uWSGI до создания рабочих
+# процессов, и соединение из пула досталось бы им всем
+try:
+    dbconn = db_pool.acquire()
+except storage.OperationalError:
+    app.logger.error(traceback.format_exc())
+    app.logger.error('Could not connect to the DB. Exiting...')
     exit()
 
+# Движок загружается до обработки запросов (в мастер-процессе uWSGI,
+# рабочие процессы получают его при создании)
+try:
+    if conf.use_memory_engine:
+        memory_engine = engine.AddressOKEngine(dbconn, version_tracker.get(dbconn))
+except Exception:
+    app.logger.error(traceback.format_exc())
+finally:
+    db_pool.release(dbconn, broken=True)
+    dbconn = None
+
+def load_memory_engine(version):
+    """Загружает движок версии БД в фоновом потоке. Пока он загружается,
+    запросы обрабатывает движок предыдущей версии."""
+    global memory_engine, memory_engine_loading
+    try:
+        with db_pool.connection() as dbconn:
+            new_engine = engine.AddressOKEngine(dbconn, version)
+        with memory_engine_lock:
+            memory_engine = new_engine
+    except Exception:
+        app.logger.error(traceback.format_exc())
+    finally:
+        with memory_engine_lock:
+            memory_engine_loading = None
+
+def make_getter(dbconn):
+    """Возвращает объект для получения адресной информации. Объекты
+    используются повторно, пока не изменится версия БД."""
+    global memory_engine, memory_engine_loading
+    version = version_tracker.get(dbconn)
+
+    if conf.use_memory_engine:
+        # Движок загружается заново только при смене версии БД
+        with memory_engine_lock:
+            if memory_engine is None:
+                # Отвечать на запрос нечем, загружаем движок сразу
+                memory_engine = engine.AddressOKEngine(dbconn, version)
+            elif memory_engine.version != version and memory_engine_loading is None:
+                # До окончания загрузки в памяти находятся движки обеих версий
+                memory_engine_loading = version
+                threading.Thread(target=load_memory_engine, args=(version,),
+                    daemon=True).start()
+            return memory_engine
+
+    # Объект хранится в атрибуте соединения, поэтому удаляется вместе
+    # с закрытым соединением
+    gtr = getattr(dbconn, 'addressok_getter', None)
+    if gtr is None or gtr.version != version:
+        gtr = getter.AddressOKGetter(dbconn, version)
+        dbconn.addressok_getter = gtr
+    return gtr
+
+def get_zip_index(version):
+    """Возвращает открытый файл индекса почтовых индексов для версии БД
+    (или None, если файла нет)."""
+    global zip_index, zip_index_version
+    if not conf.use_zip_index:
+        return None
+
+    with zip_index_lock:
+        # Наличие файла проверяется один раз для каждой версии БД
+        if zip_index_version != version:
+            zip_index = None
+            zip_index_version = version
+            fname = zipindex.index_file_name(conf.index_dir, version)
+            if os.path.exists(fname):
+                zip_index = zipindex.ZipIndex(fname, version)
+        return zip_index
+
+def cached_response(gtr, request_type, params, get_result):
+    """Возвращает сериализованный ответ из кэша, а при его отсутствии
+    получает результат с помощью get_result() и сохраняет его в кэше."""
+    data = response_cache.get(gtr.version, request_type, params)
+    if data is None:
+        res = get_result()
+        res['result'] = 'ok'
+        data = json.dumps(res).encode('utf-8')
+        response_cache.put(gtr.version, request_type, params, data)
+    return data
+
+def get_initial_response(gtr):
+    """Возвращает сериализованный ответ для незаполненной формы.
+    Ответ формируется один раз для каждой версии БД."""
+    global initial_response
+    version, data = initial_response
+    if version != gtr.version or data is None:
+        res = gtr.get_initial_addr_objects()
+        res['result'] = 'ok'
+        data = json.dumps(res).encode('utf-8')
+        initial_response = (gtr.version, data)
+    return data
+
+def parse_lookup(lookup):
+    """Возвращает тип запроса и нормализованные параметры одного запроса
+    из пакетного запроса."""
+    if lookup['request_type'] == 'zip':
+        return 'zip', (str(lookup['zip_code']),)
+    elif lookup['request_type'] == 'all':
+        ao_id = getter.AddressOKGetter.select_ao_id(int(lookup['region_id']),
+            int(lookup['district_id']), int(lookup['place_id']),
+            int(lookup['street_id']))
+        return 'all', (ao_id, str(lookup['zip_code']))
+    raise ValueError('Unknown request type: %s' % lookup['request_type'])
+
+def get_batch_response(gtr, lookups):
+    """Возвращает сериализованный ответ на пакетный запрос. Ответы,
+    которых нет в кэше, получаются одним обращением к gtr."""
+    if len(lookups) > conf.batch_max_size:
+        raise ValueError('Too many lookups in batch: %s' % len(lookups))
+
+    lookups = [parse_lookup(lookup) for lookup in lookups]
+    items = [response_cache.get(gtr.version, request_type, params)
+        for request_type, params in lookups]
+
+    missing = [i for i, data in enumerate(items) if data is None]
+    if len(missing) > 0:
+        results = gtr.get_addr_objects_batch(
+            [(lookups[i][0],) + lookups[i][1] for i in missing])
+        for i, res in zip(missing, results):
+            res = dict(res, result='ok')
+            items[i] = json.dumps(res).encode('utf-8')
+            response_cache.put(gtr.version, lookups[i][0], lookups[i][1], items[i])
+
+    return b'{"items": [' + b', '.join(items) + b'], "result": "ok"}'
+
+def process_request(gtr):
+    """Обрабатывает запрос и возвращает сериализованный ответ."""
+    # Запрос адресных данных по почтовому индексу
+    if request.form['request_type'] == 'zip':
+        zip_code = request.form['zip_code']
+        index = get_zip_index(gtr.version)
+        return cached_response(gtr, 'zip', (zip_code,),
+            lambda: (index or gtr).get_addr_objects_by_zip_code(zip_code))
+    # Запрос адресных данных по всем полям
+    elif request.form['request_type'] == 'all':
+        ao_id = gtr.select_ao_id(int(request.form['region_id']),
+            int(request.form['district_id']), int(request.form['place_id']),
+            int(request.form['street_id']))
+        zip_code = request.form['zip_code']
+        if ao_id == 0 and zip_code.strip() == '':
+            return get_initial_response(gtr)
+        return cached_response(gtr, 'all', (ao_id, zip_code),
+            lambda: gtr.get_addr_objects(ao_id, zip_code))
+    # Поиск дочерних объектов по началу наименования
+    elif request.form['request_type'] == 'search':
+        parent_id = int(request.form['parent_id'])
+        field = request.form['level']
+        prefix = request.form['prefix'].strip().lower()
+        try:
+            limit = int(request.form.get('limit', conf.search_limit))
+        except ValueError:
+            return json.dumps({'result': 'error', 'error_message': 'Invalid limit'})
+        limit = max(1, min(limit, conf.search_max_limit))
+        return cached_response(gtr, 'search', (parent_id, field, prefix, limit),
+            lambda: gtr.search_addr_objects(parent_id, field, prefix, limit))
+    # Пакетный запрос (JSON-массив запросов в поле lookups)
+    elif request.form['request_type'] == 'batch':
+        return get_batch_response(gtr, json.loads(request.form['lookups']))
+
+    return json.dumps({})
+
 @app.route('/', methods=['POST'])
 def get_addr():
     res = {}
-    global dbconn
     try:
-        gtr = getter.AddressOKGetter(dbconn)
-    except pymysql.err.OperationalError as err:
-        # если ошибка "Lost connection to MySQL server during query" (2013)
-        # или "MySQL server has gone away" (2006)
-        if err.args[0] in (2013, 2006):
-            time.sleep(0.1)
-            dbconn = connect_to_mysql()
-            gtr = getter.AddressOKGetter(dbconn)
-        else:
-            raise
-
-    try:
-        # Запрос адресных данных по почтовому индексу
-        if request.form['request_type'] == 'zip':
-            res = gtr.get_addr_objects_by_zip_code(request.form['zip_code'])
-            res['result'] = 'ok'
-        # Запрос адресных данных по всем полям
-        elif request.form['request_type'] == 'all':
-            res = gtr.get_addr_objects_raw(int(request.form['region_id']),
-                int(request.form['district_id']), int(request.form['place_id']),
-                int(request.form['street_id']), request.form['zip_code'])
-            res['result'] = 'ok'
+        # Если соединение с БД потеряно, запрос повторяется один раз
+        # с другим соединением
+        for attempt in range(2):
+            try:
+                with db_pool.connection() as dbconn:
+                    return process_request(make_getter(dbconn))
+            except storage.OperationalError as err:
+                if err.args[0] not in dbpool.CONNECTION_ERRORS or attempt > 0:
+                    raise
+                app.logger.warning('Lost connection to MySQL server. Retrying...')
     except Exception as e:
         # Logging error
         app.logger.error('EXCEPTION!\n'+str(e)+'\n'+traceback.format_exc())
@@ -75,7 +248,12 @@ def get_addr():
 
     return json.dumps(res)
 
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """Возвращает статистику кэша ответов."""
+    return json.dumps({'cache': response_cache.stats()})
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=14000, debug=True)
-    dbconn.close()
+    db_pool.close()
     print('\nDone.')
\ No newline at end of file
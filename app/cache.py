@@ -0,0 +1,91 @@
+from collections import OrderedDict
+import threading, time
+
+
+class ResponseCache:
+    """Кэш сериализованных ответов сервиса (LRU с ограничением
+    по количеству записей, объёму и времени жизни).
+
+    Ключ записи -- (версия БД, тип запроса, нормализованные параметры).
+    Ответы зависят только от параметров запроса и версии БД, поэтому
+    при смене версии БД кэш очищается целиком.
+    """
+
+    def __init__(self, max_items=10000, max_bytes=64*1024*1024, ttl=0):
+        # Максимальное кол-во записей (0 -- кэш отключен)
+        self.max_items = max_items
+        # Максимальный суммарный размер ответов в байтах
+        self.max_bytes = max_bytes
+        # Время жизни записи в секундах (0 -- без ограничения)
+        self.ttl = ttl
+
+        self.version = None
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _check_version(self, version):
+        """Очищает кэш, если изменилась версия БД."""
+        if version != self.version:
+            self.items.clear()
+            self.size = 0
+            self.version = version
+
+    def get(self, version, request_type, params):
+        """Возвращает ответ из кэша (или None, если его там нет)."""
+        if self.max_items <= 0:
+            return None
+
+        key = (request_type, params)
+        with self.lock:
+            self._check_version(version)
+            item = self.items.get(key)
+            if item is not None and self.ttl > 0 and item[1] < time.time():
+                del self.items[key]
+                self.size -= len(item[0])
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, version, request_type, params, data):
+        """Сохраняет ответ (bytes) в кэше."""
+        if self.max_items <= 0 or len(data) > self.max_bytes:
+            return
+
+        key = (request_type, params)
+        expires = time.time() + self.ttl if self.ttl > 0 else 0
+        with self.lock:
+            self._check_version(version)
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.items[key] = (data, expires)
+            self.size += len(data)
+
+            # Удаляем давно не использовавшиеся записи
+            while len(self.items) > self.max_items or self.size > self.max_bytes:
+                old_key, old = self.items.popitem(last=False)
+                self.size -= len(old[0])
+
+    def clear(self):
+        """Очищает кэш."""
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def stats(self):
+        """Возвращает статистику использования кэша."""
+        with self.lock:
+            return {
+                'version': self.version,
+                'items': len(self.items),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -1,11 +1,14 @@
 """Скрипт проверяет наличие новой версии БД ФИАС и при необходимости
 скачивает архив с новой версией и обновляет данные в БД."""
 
-import os, subprocess, time
+import os, subprocess, time, argparse
 from datetime import datetime
 import urllib.request
 import pymysql
 import initializer
+import dbversion
+import zipindex
+import rarstream
 import conf
 
 def ensure_dir(dirname):
@@ -20,19 +23,53 @@ def drop_tables(conn, db_version):
     cur.execute('DROP TABLE socrbase_v%s' % db_version)
     cur.execute('DROP TABLE zipcodes_v%s' % db_version)
     cur.execute('DROP TABLE ziplinks_v%s' % db_version)
+    cur.execute('DROP TABLE IF EXISTS addrpaths_v%s' % db_version)
     cur.close()
 
+def find_source_file(dirname, prefix):
+    """Возвращает имя распакованного XML-файла с данным префиксом
+    (или пустую строку, если его нет)."""
+    if not os.path.exists(dirname):
+        return ''
+    for fname in os.listdir(dirname):
+        if fname.startswith(prefix):
+            return os.path.join(dirname, fname)
+    return ''
+
+def find_sources(rar_fname):
+    """Возвращает файлы с адресными объектами и сокращениями: файлы
+    в архиве, которые читаются без распаковки (если задан параметр
+    conf.stream_from_archive), или распакованные файлы."""
+    if conf.stream_from_archive:
+        if not os.path.exists(rar_fname):
+            return None, None
+        return rarstream.find_file(rar_fname, 'AS_ADDROBJ_'), \
+            rarstream.find_file(rar_fname, 'AS_SOCRBASE_')
+    return find_source_file(data_dir, 'AS_ADDROBJ_'), \
+        find_source_file(data_dir, 'AS_SOCRBASE_')
+
+parser = argparse.ArgumentParser(description='Обновление БД ФИАС.')
+parser.add_argument('--regions',
+    help='коды загружаемых регионов через запятую (по умолчанию conf.regions)')
+args = parser.parse_args()
+# Коды загружаемых регионов (None -- все регионы)
+regions = args.regions.split(',') if args.regions else conf.regions
+
 # Папка для XML с исходными данными
 data_dir = conf.data_dir
 
 dbconn = None
 
-def connect_to_db():
-    global dbconn
-    dbconn = pymysql.connect(host=conf.db_host, user=conf.db_user,
+def new_connection():
+    """Создаёт новое соединение с БД."""
+    return pymysql.connect(host=conf.db_host, user=conf.db_user,
         passwd=conf.db_password, db=conf.db_name, port=conf.db_port,
         charset='utf8')
 
+def connect_to_db():
+    global dbconn
+    dbconn = new_connection()
+
 # Пытаемся приконнектиться в течение 10 секунд
 for i in range(0, 10, 1):
     try:
@@ -89,64 +126,85 @@ fias_ver_date = data.decode('utf-8')
 # Если дата последней актуальной версии БД с сайта ФИАС отличается,
 # то запускаем процесс обновления
 if fias_ver_date != cur_ver_date:
-    # Скачиваем архив
-    print('New version detected')
-    print('Downloading file...')
-    rar_fname = os.path.join(data_dir, 'fias_xml.rar')
-    os.system('rm -rf %s/*' % data_dir)
-    os.system('wget http://fias.nalog.ru/Public/Downloads/Actual/fias_xml.rar -P %s' % data_dir)
-    print('Done.')
-
-    # Имя XML-файла с адресными объектами
-    addrobj_file_name = ''
-    # Имя XML-файла с сокращениями
-    socr_file_name = ''
-
-    # Получаем список файлов
-    files_list = subprocess.check_output('unrar lb %s' % rar_fname,
-        stderr=subprocess.STDOUT, shell=True).splitlines()
-    for filename in files_list:
-        if filename.decode('utf-8').startswith(('AS_ADDROBJ_', 'AS_SOCRBASE_')):
-            # Распаковываем
-            fname = os.path.join(data_dir, filename.decode('utf-8'))
-            cmd_str = "unrar e %s %s %s" % (rar_fname,
-                filename.decode('utf-8'), data_dir)
-            os.system(cmd_str)
-
-            if filename.decode('utf-8').startswith('AS_ADDROBJ_'):
-                addrobj_file_name = fname
-            elif filename.decode('utf-8').startswith('AS_SOCRBASE_'):
-                socr_file_name = fname
+    connect_to_db()
+    init = initializer.AddressOKInitializer(dbconn, next_db_version,
+        connect=new_connection, regions=regions)
+
+    # Обновляем данные по файлу изменений, если есть предыдущая
+    # версия, загруженная с сайта ФИАС (и GUID'ы в ней хранятся
+    # в двоичном виде)
+    delta = conf.update_mode == 'delta' and not do_create_options and cur_ver_date != ''
+    if delta and not init.has_binary_guids(next_db_version-1):
+        print('Version %s stores GUIDs as strings. Full rebuild required.'
+            % (next_db_version-1))
+        delta = False
+    if delta:
+        archive_name = 'fias_delta_xml.rar'
+        build_source = fias_ver_date+' delta'
+    else:
+        archive_name = 'fias_xml.rar'
+        build_source = fias_ver_date
+    if init.regions is not None:
+        # Сборка с другим списком регионов не продолжается
+        build_source += ' regions ' + ','.join(sorted(init.regions))
+
+    rar_fname = os.path.join(data_dir, archive_name)
+    # Файлы с адресными объектами и сокращениями
+    addrobj_source, socr_source = None, None
+
+    # Если предыдущая сборка этой версии была прервана, а архив
+    # (или распакованные файлы) остался, то продолжаем её без повторного
+    # скачивания
+    if len(init.get_finished_stages(build_source)) > 0:
+        addrobj_source, socr_source = find_sources(rar_fname)
+    if addrobj_source and (delta or socr_source):
+        print('Resuming build of version %s' % next_db_version)
+    else:
+        dbconn.close()
+
+        # Скачиваем архив
+        print('New version detected')
+        print('Downloading file...')
+        os.system('rm -rf %s/*' % data_dir)
+        os.system('wget http://fias.nalog.ru/Public/Downloads/Actual/%s -P %s' % (archive_name, data_dir))
+        print('Done.')
+
+        if not conf.stream_from_archive:
+            # Получаем список файлов
+            files_list = subprocess.check_output('unrar lb %s' % rar_fname,
+                stderr=subprocess.STDOUT, shell=True).splitlines()
+            for filename in files_list:
+                if filename.decode('utf-8').startswith(('AS_ADDROBJ_', 'AS_SOCRBASE_')):
+                    # Распаковываем
+                    cmd_str = "unrar e %s %s %s" % (rar_fname,
+                        filename.decode('utf-8'), data_dir)
+                    os.system(cmd_str)
+
+        addrobj_source, socr_source = find_sources(rar_fname)
 
-    t1 = datetime.now()
+        connect_to_db()
+        init.dbconn = dbconn
 
-    connect_to_db()
+    t1 = datetime.now()
 
-    init = initializer.AddressOKInitializer(dbconn, next_db_version)
-
-    # Создаём таблицы в БД
-    init.create_tables()
-    
-    # Загружаем данные
-    init.load_address_objects(addrobj_file_name)
-    init.load_socr(socr_file_name)
-
-    # Прочие необходимые действия (заполнение поля parentid, индексов,
-    # наименований адресных объектов и т.д.)
-    init.fill_parent_ids()
-    init.fill_zip_codes()
-    init.fill_zip_links()
-    init.fill_socr_codes()
-    init.fill_socr_names()
-    init.fill_addrobj_socr()
-    init.fill_socr_diplaynames()
-    init.fill_good_names()
+    # Создаём и заполняем таблицы (завершённые этапы сборки
+    # пропускаются)
+    if delta:
+        init.build_delta(next_db_version-1, addrobj_source, source=build_source,
+            defer_indexes=conf.defer_indexes, index_dir=conf.index_dir,
+            report_file=conf.build_report_file % next_db_version)
+    else:
+        init.build(addrobj_source, socr_source, source=build_source,
+            mode=conf.build_mode, processes=conf.build_processes,
+            defer_indexes=conf.defer_indexes, index_dir=conf.index_dir,
+            report_file=conf.build_report_file % next_db_version)
 
     t2 = datetime.now()
     # Время инициализации
     print("Initializing time:", t2 - t1)
 
     # Увеличиваем на 1 номер текущей версии
+    cursor = dbconn.cursor()
     if do_create_options:
         cursor.execute("""INSERT INTO options (db_version, fias_ver_date)
             VALUES (%(db_version)s, '%(ver_date)s')
@@ -163,6 +221,15 @@ if fias_ver_date != cur_ver_date:
                 'ver_date': fias_ver_date
             })
 
+    dbconn.commit()
+    cursor.close()
+
+    # Сборка завершена
+    init.reset_build_state()
+
+    # Уведомляем процессы сервиса о смене версии БД
+    dbversion.write_version_file(conf.version_file, next_db_version)
+
     # Пауза перед удалением таблиц для того, чтобы завершились
     # запросы к сервису, выполняемые в данный момент
     print('Sleeping... Z-z-z...')
@@ -171,6 +238,9 @@ if fias_ver_date != cur_ver_date:
     # Удаляем таблицы предыдущей версии
     if next_db_version > 1:
         drop_tables(dbconn, next_db_version-1)
+        old_index_file = zipindex.index_file_name(conf.index_dir, next_db_version-1)
+        if os.path.exists(old_index_file):
+            os.remove(old_index_file)
 
     dbconn.commit()
     dbconn.close()
@@ -1,3 +1,7 @@
+# БД: 'mysql' или 'sqlite' (файл sqlite_file, например для сборки
+# версии БД без сервера MySQL, см. storage.py)
+db_engine = 'mysql'
+sqlite_file = '/data/addressok.sqlite'
 # Имя хоста с MySQL
 db_host = 'mysql'
 # Пользователь БД
@@ -10,7 +14,76 @@ db_root_password = 'ds3M3d9M'
 db_name = 'addressok'
 # Порт БД
 db_port = 3306
+# Пул соединений с БД (на один процесс): максимальное кол-во соединений,
+# время простоя в секундах, после которого соединение закрывается,
+# и кол-во повторных попыток подключения
+db_pool_size = 4
+db_pool_max_idle_time = 300
+db_connect_retries = 7
+# Соединения из пула проверяются перед выдачей; соединения, которые
+# простаивали меньше db_pool_check_interval секунд, выдаются без
+# проверки (0 -- проверяется каждое соединение)
+db_pool_check_interval = 0
+# Файл с номером текущей версии БД (записывается после обновления БД)
+version_file = '/data/db_version'
+# Время в секундах, в течение которого номер версии БД не перечитывается
+# из БД (должно быть меньше паузы перед удалением таблиц старой версии)
+version_ttl = 5
 # Папка для XML с исходными данными
 data_dir = '/data/srcxml'
+# Читать XML из скачанного архива без распаковки на диск. Экономит
+# место на диске, но XML с адресными объектами разбирается в одном
+# процессе по мере распаковки (build_processes для разбора не
+# используется, сборка заметно дольше). Распакованный файл разбирается
+# по частям в build_processes процессах
+stream_from_archive = False
+# Кол-во процессов для разбора XML и вычисления отображаемых имён
+# при обновлении БД (None -- по кол-ву процессоров)
+build_processes = None
+# Режим загрузки данных при обновлении БД: 'multi_pass' -- таблица ADDROBJ
+# загружается, а затем дополняется отдельными проходами, 'single_pass' --
+# каждая строка ADDROBJ вычисляется в памяти и записывается один раз,
+# 'regions' -- таблица ADDROBJ дополняется по регионам в build_processes
+# процессах (у каждого процесса своё соединение с БД)
+build_mode = 'multi_pass'
+# Способ обновления БД: 'full' -- новая версия собирается из полной
+# выгрузки ФИАС, 'delta' -- из таблиц текущей версии и файла изменений
+# (обновление должно запускаться для каждой версии ФИАС, иначе
+# пропущенные изменения не попадут в БД). Версия, в которой GUID'ы
+# хранятся в виде строк, обновляется полной сборкой
+update_mode = 'full'
+# Коды регионов, адресные объекты которых загружаются в БД, например
+# ['77', '50'] (None -- все регионы). Можно задать аргументом --regions
+# скриптов check_update.py и init.py. При обновлении по файлу изменений
+# должен совпадать со списком, с которым собрана текущая версия БД
+regions = None
+# Создавать вторичные индексы таблиц после загрузки данных
+# (а не поддерживать их при каждой вставке)
+defer_indexes = True
+# Папка для файлов индексов почтовых индексов (по одному на версию БД)
+index_dir = '/data/index'
+# Файл с показателями этапов сборки версии БД (JSON, %s -- номер версии)
+build_report_file = '/logs/build_v%s.json'
 # Файл логов
-log_file = '/logs/app.log'
\ No newline at end of file
+log_file = '/logs/app.log'
+# Отвечать на запросы из памяти (адресные данные загружаются из БД
+# один раз для каждой версии БД)
+use_memory_engine = False
+# Кэш ответов: максимальное кол-во записей (0 -- кэш отключен),
+# максимальный объём в байтах и время жизни записи в секундах
+# (0 -- без ограничения)
+cache_max_items = 10000
+cache_max_bytes = 64*1024*1024
+cache_ttl = 0
+# Максимальное кол-во запросов в одном пакетном запросе
+batch_max_size = 1000
+# Кол-во подсказок, возвращаемых при поиске по началу наименования,
+# по умолчанию и максимальное. Отсортированные списки дочерних объектов
+# для поиска двоичным поиском строятся только в памяти (use_memory_engine);
+# без него поиск выполняется запросом LIKE 'начало%' по индексу
+# (parentid, aolevel, formalname) таблицы ADDROBJ
+search_limit = 10
+search_max_limit = 100
+# Отвечать на запросы по почтовому индексу из файла индекса
+# (см. zipindex.py), если он есть для текущей версии БД
+use_zip_index = True
\ No newline at end of file
@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+import threading, time
+import storage
+
+# Коды ошибок, при которых соединение считается потерянным:
+# "Can't connect to MySQL server" (2003), "MySQL server has gone away" (2006),
+# "Lost connection to MySQL server during query" (2013)
+CONNECTION_ERRORS = (2003, 2006, 2013)
+
+
+class ConnectionPool:
+    """Пул соединений с БД для одного процесса (uWSGI worker'а).
+
+    Перед выдачей соединение проверяется (ping). Соединения, которые
+    простаивали меньше check_interval секунд, можно выдавать без
+    проверки (по умолчанию проверяется каждое соединение), а соединения,
+    которые простаивали дольше max_idle_time секунд, закрываются. Новые соединения
+    создаются с повторными попытками и увеличивающейся паузой между
+    ними. Пул можно использовать из нескольких потоков.
+    """
+
+    def __init__(self, connect, max_size=4, max_idle_time=300,
+            connect_retries=5, backoff=0.1, check_interval=0):
+        # Функция, создающая новое соединение
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.connect_retries = connect_retries
+        self.backoff = backoff
+        # Соединения, простаивавшие меньше check_interval секунд,
+        # выдаются без проверки
+        self.check_interval = check_interval
+
+        # Свободные соединения: (соединение, время возврата в пул)
+        self.idle = []
+        self.lock = threading.Lock()
+        # Ограничивает кол-во одновременно выданных соединений
+        self.semaphore = threading.BoundedSemaphore(max_size)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _new_connection(self):
+        """Создаёт новое соединение (с повторными попытками)."""
+        delay = self.backoff
+        for attempt in range(self.connect_retries + 1):
+            try:
+                return self.connect()
+            except storage.OperationalError as err:
+                if err.args[0] not in CONNECTION_ERRORS or attempt == self.connect_retries:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    def _take_idle(self):
+        """Возвращает проверенное свободное соединение (или None)."""
+        while True:
+            with self.lock:
+                if len(self.idle) == 0:
+                    return None
+                conn, released = self.idle.pop()
+
+            idle_time = time.time() - released
+            if idle_time > self.max_idle_time:
+                self._close(conn)
+                continue
+            if idle_time >= self.check_interval:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self._close(conn)
+                    continue
+            return conn
+
+    def acquire(self):
+        """Выдаёт соединение из пула."""
+        self.semaphore.acquire()
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = self._new_connection()
+            return conn
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def release(self, conn, broken=False):
+        """Возвращает соединение в пул. Потерянные соединения
+        (broken=True) закрываются."""
+        try:
+            if broken:
+                self._close(conn)
+            else:
+                with self.lock:
+                    self.idle.append((conn, time.time()))
+        finally:
+            self.semaphore.release()
+
+    @contextmanager
+    def connection(self):
+        """Выдаёт соединение на время выполнения блока with."""
+        conn = self.acquire()
+        try:
+            yield conn
+        except storage.OperationalError as err:
+            self.release(conn, broken=err.args[0] in CONNECTION_ERRORS)
+            raise
+        except Exception:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        """Закрывает все свободные соединения."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, released in idle:
+            self._close(conn)
@@ -0,0 +1,71 @@
+import os, threading, time
+import getter
+
+
+def write_version_file(fname, version):
+    """Записывает номер текущей версии БД в файл (уведомление
+    для процессов сервиса о смене версии)."""
+    if not fname:
+        return
+    tmp_fname = fname+'.tmp'
+    with open(tmp_fname, 'w') as f:
+        f.write(str(version))
+    os.rename(tmp_fname, fname)
+
+
+class VersionTracker:
+    """Хранит номер текущей версии БД в памяти процесса.
+
+    Номер версии перечитывается из таблицы OPTIONS не чаще, чем раз
+    в ttl секунд. Если задан файл версии (его записывает check_update.py
+    после обновления), то при изменении файла номер версии берётся
+    из него сразу.
+    """
+
+    def __init__(self, ttl=5, version_file=None):
+        self.ttl = ttl
+        self.version_file = version_file
+
+        self.version = None
+        # Время, до которого номер версии считается актуальным
+        self.expires = 0
+        # Время изменения файла версии при последней проверке
+        self.file_mtime = None
+        self.lock = threading.Lock()
+
+    def _read_version_file(self):
+        """Возвращает номер версии из файла, если файл изменился
+        с момента последней проверки (иначе None)."""
+        if not self.version_file:
+            return None
+        try:
+            mtime = os.stat(self.version_file).st_mtime
+        except OSError:
+            return None
+        if mtime == self.file_mtime:
+            return None
+        try:
+            with open(self.version_file) as f:
+                version = int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+        self.file_mtime = mtime
+        return version
+
+    def get(self, dbconn):
+        """Возвращает номер текущей версии БД."""
+        with self.lock:
+            now = time.time()
+            version = self._read_version_file()
+            if version is None and (self.version is None or now >= self.expires):
+                version = getter.get_db_version(dbconn)
+            if version is not None:
+                self.version = version
+                self.expires = now + self.ttl
+            return self.version
+
+    def reset(self):
+        """Сбрасывает сохранённый номер версии."""
+        with self.lock:
+            self.version = None
+            self.expires = 0
@@ -0,0 +1,421 @@
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+import storage
+import getter
+
+# Уровни адресных объектов, используемые в форме ввода адреса
+AOLEVELS = OrderedDict([
+    (1, 'region'),
+    (3, 'district'),
+    (4, 'place'),
+    (6, 'place'),
+    (7, 'street'),
+])
+
+# Поля формы ввода адреса
+FIELDS = ('region', 'district', 'place', 'street')
+
+
+def _sort_key(name):
+    """Возвращает ключ сортировки наименования (аналог сортировки
+    MySQL с collation utf8_general_ci)."""
+    return (name or '').lower().replace('ё', 'е')
+
+
+def _contains(items, value, lo, hi):
+    """Проверяет наличие значения в отсортированном участке
+    items[lo:hi] массива."""
+    pos = bisect_left(items, value, lo, hi)
+    return pos < hi and items[pos] == value
+
+
+def _group(cnt, keys, values):
+    """Группирует значения по ключам (числам от 0 до cnt-1). Возвращает
+    массивы (offsets, items): значения ключа k находятся
+    в items[offsets[k]:offsets[k+1]] в порядке следования в values."""
+    offsets = array('l', [0]) * (cnt + 1)
+    for key in keys:
+        offsets[key + 1] += 1
+    for i in range(cnt):
+        offsets[i + 1] += offsets[i]
+
+    items = array('l', [0]) * len(values)
+    positions = array('l', offsets)
+    for key, value in zip(keys, values):
+        items[positions[key]] = value
+        positions[key] += 1
+    return offsets, items
+
+
+class _StringColumn:
+    """Столбец строк, хранящихся в одном блоке байтов (UTF-8): строка
+    с номером i находится в data[offsets[i]:offsets[i+1]].
+
+    Байты UTF-8 сравниваются в том же порядке, что и строки, поэтому
+    для сравнения строки не декодируются (см. raw).
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('l', [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def append(self, value):
+        self.data += value.encode('utf-8')
+        self.offsets.append(len(self.data))
+
+    def raw(self, i):
+        """Возвращает строку с номером i в виде байтов UTF-8."""
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def find(self, value):
+        """Возвращает номер строки value в отсортированном столбце
+        (или None, если строки нет)."""
+        key = value.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            middle = (lo + hi) // 2
+            if self.raw(middle) < key:
+                lo = middle + 1
+            else:
+                hi = middle
+        if lo < len(self) and self.raw(lo) == key:
+            return lo
+        return None
+
+
+class AddressOKEngine(getter.AddressOKGetter):
+    """Класс, предоставляющий тот же функционал, что и AddressOKGetter,
+    но отвечающий на запросы без обращения к БД.
+
+    При создании один раз загружает из таблиц ADDROBJ, ZIPCODES
+    и ZIPLINKS данной версии БД все необходимые поля в компактные
+    массивы (по столбцу на поле, строки -- в блоках байтов, см.
+    _StringColumn) и строит индексы дочерних объектов.
+    Адресные данные между обновлениями БД не изменяются, поэтому
+    экземпляр можно использовать до смены версии.
+    """
+
+    def __init__(self, dbconn, version=None):
+        super().__init__(dbconn, version)
+        self.load()
+        # После загрузки соединение с БД не используется
+        self.dbconn = None
+
+    def load(self):
+        """Загружает адресные объекты и почтовые индексы из БД."""
+        self._load_address_objects()
+        self._build_children_index()
+        self._build_search_index()
+        self._load_zip_codes()
+
+    def _load_address_objects(self):
+        # ID адресных объектов (по возрастанию)
+        self.ids = array('q')
+        # Индексы родительских объектов в массивах (-1, если родителя нет)
+        self.parents = array('l')
+        self.levels = array('h')
+        self.displaynames = _StringColumn()
+        # Позиция объекта в списке, отсортированном по FORMALNAME
+        self.ranks = array('l')
+
+        parent_ids = array('q')
+        # Ключи сортировки FORMALNAME
+        self.keys = keys = _StringColumn()
+
+        cur = self.dbconn.cursor(storage.SSCursor)
+        sql = """SELECT
+                id,
+                parentid,
+                aolevel,
+                displayname,
+                formalname
+            FROM addrobj%(version_suffix)s
+            ORDER BY id""" % {
+                'version_suffix': self.version_suffix
+            }
+        cur.execute(sql)
+        for ao_id, parentid, aolevel, displayname, formalname in cur:
+            self.ids.append(ao_id)
+            parent_ids.append(parentid or 0)
+            self.levels.append(aolevel or 0)
+            self.displaynames.append(displayname or '')
+            keys.append(_sort_key(formalname))
+        cur.close()
+
+        for parentid in parent_ids:
+            idx = self._index_of(parentid) if parentid != 0 else None
+            self.parents.append(idx if idx is not None else -1)
+
+        # Все объекты в порядке сортировки по FORMALNAME
+        self.order = array('l', sorted(range(len(keys)), key=keys.raw))
+        self.ranks = array('l', [0]) * len(keys)
+        for rank, idx in enumerate(self.order):
+            self.ranks[idx] = rank
+
+    def _build_children_index(self):
+        """Строит индекс дочерних объектов: дочерние объекты объекта
+        с индексом i находятся в self.children[child_offsets[i]:child_offsets[i+1]]
+        и отсортированы по FORMALNAME."""
+        cnt = len(self.ids)
+        self.child_offsets = array('l', [0]) * (cnt + 1)
+        for parent in self.parents:
+            if parent >= 0:
+                self.child_offsets[parent + 1] += 1
+        for i in range(cnt):
+            self.child_offsets[i + 1] += self.child_offsets[i]
+
+        self.children = array('l', [0]) * self.child_offsets[cnt]
+        positions = array('l', self.child_offsets)
+        # Регионы (объекты первого уровня)
+        self.regions = array('l')
+        for idx in self.order:
+            parent = self.parents[idx]
+            if parent >= 0:
+                self.children[positions[parent]] = idx
+                positions[parent] += 1
+            if self.levels[idx] == 1:
+                self.regions.append(idx)
+
+    def _build_search_index(self):
+        """Строит индекс для поиска по началу наименования: дочерние
+        объекты объекта с индексом i, относящиеся к полю формы с номером f,
+        находятся в self.search_children[search_offsets[i*4+f]:search_offsets[i*4+f+1]]
+        и отсортированы по FORMALNAME."""
+        cnt = len(self.ids)
+        nfields = len(FIELDS)
+        field_nums = dict([(level, FIELDS.index(field))
+            for level, field in AOLEVELS.items()])
+
+        self.search_offsets = array('l', [0]) * (cnt * nfields + 1)
+        for idx in range(cnt):
+            parent = self.parents[idx]
+            field_num = field_nums.get(self.levels[idx])
+            if parent >= 0 and field_num is not None:
+                self.search_offsets[parent * nfields + field_num + 1] += 1
+        for i in range(cnt * nfields):
+            self.search_offsets[i + 1] += self.search_offsets[i]
+
+        self.search_children = array('l', [0]) * self.search_offsets[cnt * nfields]
+        positions = array('l', self.search_offsets)
+        for idx in self.order:
+            parent = self.parents[idx]
+            field_num = field_nums.get(self.levels[idx])
+            if parent >= 0 and field_num is not None:
+                pos = parent * nfields + field_num
+                self.search_children[positions[pos]] = idx
+                positions[pos] += 1
+
+    def _load_zip_codes(self):
+        """Загружает почтовые индексы: self.zip_codes -- почтовые индексы
+        по возрастанию, адресные объекты почтового индекса с номером z
+        находятся в self.zip_objects[zip_offsets[z]:zip_offsets[z+1]],
+        почтовые индексы объекта с индексом i -- в
+        self.obj_zips[obj_zip_offsets[i]:obj_zip_offsets[i+1]]
+        (по возрастанию)."""
+        cur = self.dbconn.cursor(storage.SSCursor)
+        sql = """SELECT id, zip FROM zipcodes%(version_suffix)s""" % {
+            'version_suffix': self.version_suffix
+        }
+        cur.execute(sql)
+        rows = sorted(cur, key=lambda row: row[1].encode('utf-8'))
+        cur.close()
+
+        self.zip_codes = _StringColumn()
+        # ID почтового индекса -> его номер в self.zip_codes
+        zip_nums = {}
+        for zip_id, zip_code in rows:
+            zip_nums[zip_id] = len(self.zip_codes)
+            self.zip_codes.append(zip_code)
+        rows = None
+
+        link_zips = array('l')
+        link_objects = array('l')
+        cur = self.dbconn.cursor(storage.SSCursor)
+        sql = """SELECT zipid, aoid FROM ziplinks%(version_suffix)s""" % {
+            'version_suffix': self.version_suffix
+        }
+        cur.execute(sql)
+        for zip_id, aoid in cur:
+            idx = self._index_of(aoid)
+            if idx is None or zip_id not in zip_nums:
+                continue
+            link_zips.append(zip_nums[zip_id])
+            link_objects.append(idx)
+        cur.close()
+
+        cnt_zips = len(self.zip_codes)
+        self.zip_offsets, self.zip_objects = _group(cnt_zips, link_zips, link_objects)
+        for z in range(cnt_zips):
+            start, stop = self.zip_offsets[z], self.zip_offsets[z + 1]
+            self.zip_objects[start:stop] = array('l', sorted(self.zip_objects[start:stop]))
+
+        # Почтовые индексы объектов в порядке возрастания
+        link_zips = array('l')
+        for z in range(cnt_zips):
+            link_zips.extend([z] * (self.zip_offsets[z + 1] - self.zip_offsets[z]))
+        self.obj_zip_offsets, self.obj_zips = _group(len(self.ids),
+            self.zip_objects, link_zips)
+
+    def _index_of(self, ao_id):
+        """Возвращает индекс адресного объекта в массивах
+        (или None, если объекта с таким ID нет)."""
+        pos = bisect_left(self.ids, ao_id)
+        if pos < len(self.ids) and self.ids[pos] == ao_id:
+            return pos
+        return None
+
+    def _item(self, idx):
+        return {'value': self.ids[idx], 'label': self.displaynames[idx]}
+
+    def get_parent_ids(self, ao_id):
+        """Возвращает список ID для адресного объекта с данным ID."""
+        ret = []
+        idx = self._index_of(ao_id)
+        parent = self.parents[idx] if idx is not None else -1
+        while parent >= 0:
+            ret.append(self.ids[parent])
+            parent = self.parents[parent]
+        return ret
+
+    def get_zip_codes(self, ao_id):
+        """Возвращает список почтовых индексов для
+        адресного объекта с данным ID."""
+        idx = self._index_of(ao_id)
+        if idx is None:
+            return []
+        return [self.zip_codes[z] for z in
+            self.obj_zips[self.obj_zip_offsets[idx]:self.obj_zip_offsets[idx + 1]]]
+
+    def get_addr_objects_by_zip_code(self, zip_code):
+        """Возвращает адресную информацию по почтовому индексу."""
+        res = self._empty_result(zip_code)
+
+        z = self.zip_codes.find(zip_code)
+        if z is None:
+            items = []
+        else:
+            items = [idx for idx in self.zip_objects[self.zip_offsets[z]:self.zip_offsets[z + 1]]
+                if self.levels[idx] in AOLEVELS]
+        items.sort(key=lambda idx: (self.levels[idx], self.ranks[idx]))
+        for idx in items:
+            res['suggest'][AOLEVELS[self.levels[idx]]].append(self._item(idx))
+
+        for key, items in res['suggest'].items():
+            if len(items) == 1:
+                res['fill'][key] = res['suggest'][key][0]
+                res['suggest'][key] = []
+        return res
+
+    def get_initial_addr_objects(self):
+        """Возвращает начальную адресную информацию (для инициализации
+        формы ввода адреса)."""
+        res = self._empty_result()
+        res['suggest']['region'] = [self._item(idx) for idx in self.regions]
+        return res
+
+    def get_addr_objects(self, ao_id, zip_code):
+        """Возвращает адресную информацию по ID адресного объекта
+        и почтовому индексу."""
+
+        if ao_id == 0 and zip_code.strip() == '':
+            return self.get_initial_addr_objects()
+
+        res = self._empty_result()
+
+        ao_level = 0
+        idx = self._index_of(ao_id)
+
+        # Однозначно заполненные данные
+        chain = []
+        parent = idx if idx is not None else -1
+        while parent >= 0:
+            chain.append(parent)
+            parent = self.parents[parent]
+        chain.sort(key=lambda i: self.levels[i])
+        for i in chain:
+            res['fill'][AOLEVELS[self.levels[i]]]['value'] = self.ids[i]
+            res['fill'][AOLEVELS[self.levels[i]]]['label'] = self.displaynames[i]
+        if idx is not None:
+            ao_level = self.levels[idx]
+
+        # Следующие уровни адресных объектов
+        next_levels = tuple()
+        if ao_level == 1:
+            next_levels = (3,)
+        elif ao_level == 3:
+            next_levels = (4, 6)
+        elif ao_level in (4, 6):
+            next_levels = (7,)
+
+        # Данные следующих уровней для подсказок
+        if len(next_levels) > 0:
+            z = self.zip_codes.find(zip_code)
+            if z is not None:
+                zip_start, zip_stop = self.zip_offsets[z], self.zip_offsets[z + 1]
+            for i in range(self.child_offsets[idx], self.child_offsets[idx + 1]):
+                child = self.children[i]
+                if self.levels[child] not in AOLEVELS:
+                    continue
+                if z is not None and not _contains(self.zip_objects, child, zip_start, zip_stop):
+                    continue
+                res['suggest'][AOLEVELS[self.levels[child]]].append(self._item(child))
+
+        # Почтовые индексы
+        if zip_code.strip() == '':
+            zip_codes = self.get_zip_codes(ao_id)
+            # Если почтовый индекс один, заполняем его
+            if len(zip_codes) == 1:
+                res['fill']['zip'] = zip_codes[0]
+        else:
+            res['fill']['zip'] = zip_code
+
+        return res
+
+    def get_addr_objects_batch(self, lookups):
+        """Возвращает адресную информацию для списка запросов
+        (в том же порядке, что и запросы)."""
+        res = []
+        for lookup in lookups:
+            if lookup[0] == 'zip':
+                res.append(self.get_addr_objects_by_zip_code(lookup[1]))
+            else:
+                res.append(self.get_addr_objects(lookup[1], lookup[2]))
+        return res
+
+    def search_addr_objects(self, parent_id, field, prefix, limit):
+        """Возвращает адресные объекты поля формы field, дочерние
+        для объекта parent_id, наименования которых начинаются с prefix."""
+        res = {'suggest': []}
+
+        if parent_id == 0 and field == 'region':
+            items, start, stop = self.regions, 0, len(self.regions)
+        else:
+            idx = self._index_of(parent_id)
+            if idx is None or field not in FIELDS:
+                return res
+            pos = idx * len(FIELDS) + FIELDS.index(field)
+            items = self.search_children
+            start, stop = self.search_offsets[pos], self.search_offsets[pos + 1]
+
+        # Ищем первый объект, наименование которого не меньше prefix
+        key = _sort_key(prefix).encode('utf-8')
+        end = stop
+        while start < end:
+            middle = (start + end) // 2
+            if self.keys.raw(items[middle]) < key:
+                start = middle + 1
+            else:
+                end = middle
+
+        for i in range(start, stop):
+            if len(res['suggest']) >= limit or not self.keys.raw(items[i]).startswith(key):
+                break
+            res['suggest'].append(self._item(items[i]))
+        return res
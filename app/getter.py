@@ -1,6 +1,15 @@
 from collections import OrderedDict
 import hashlib # ToDo: remove this
-import pymysql
+import storage
+
+def get_db_version(dbconn):
+    """Возвращает номер текущей версии БД из таблицы OPTIONS."""
+    cursor = dbconn.cursor(storage.DictCursor)
+    cursor.execute("SELECT db_version FROM options LIMIT 1")
+    row = cursor.fetchone()
+    res = row['db_version'] if row is not None else 0
+    cursor.close()
+    return res
 
 class AddressOKGetter:
     """Класс, предоставляющий функционал для получения
@@ -12,18 +21,31 @@ class AddressOKGetter:
         self.version_suffix = '_v'+str(self.version)
 
     def _get_version(self):
-        cursor = self.dbconn.cursor(pymysql.cursors.DictCursor)
-        cursor.execute("SELECT db_version FROM options LIMIT 1")
-        row = cursor.fetchone()
-        res = row['db_version'] if row is not None else 0
-        cursor.close()
-        return res
+        return get_db_version(self.dbconn)
+
+    def _empty_result(self, zip_code=''):
+        """Возвращает пустой ответ на запрос адресной информации."""
+        return {
+            'fill': {
+                'zip': zip_code,
+                'region': {'label': '', 'value': 0},
+                'district': {'label': '', 'value': 0},
+                'place': {'label': '', 'value': 0},
+                'street': {'label': '', 'value': 0},
+            },
+            'suggest': {
+                'region': [],
+                'district': [],
+                'place': [],
+                'street': [],
+            }
+        }
 
     def get_parent_ids(self, ao_id):
         """Возвращает список ID для адресного объекта с данным ID."""
         ret = []
 
-        cursor = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        cursor = self.dbconn.cursor(storage.DictCursor)
         sql = """SELECT parentid FROM addrobj%(version_suffix)s
             WHERE id = '%(ao_id)s'""" % {
                 'version_suffix': self.version_suffix,
@@ -39,11 +61,59 @@ class AddressOKGetter:
 
         return ret
 
+    def _get_fill_rows(self, ao_id):
+        """Возвращает адресный объект с данным ID и все его родительские
+        объекты, упорядоченные по уровню."""
+        cur = self.dbconn.cursor(storage.DictCursor)
+
+        sql = """SELECT
+                ao.id,
+                ao.aolevel,
+                ao.displayname,
+                ao.formalname
+            FROM addrpaths%(version_suffix)s p
+            INNER JOIN addrobj%(version_suffix)s ao ON ao.id = p.ancestorid
+            WHERE
+                p.aoid = %(ao_id)s
+            ORDER BY ao.aolevel""" % {
+                'version_suffix': self.version_suffix,
+                'ao_id': ao_id
+            }
+        try:
+            cur.execute(sql)
+        except storage.ProgrammingError as err:
+            # если ошибка "Table doesn't exist" (1146), то версия БД
+            # создана без таблицы ADDRPATHS и предков ищем по одному
+            if err.args[0] != 1146:
+                raise
+            ids = self.get_parent_ids(ao_id)
+            ids.insert(0, ao_id)
+
+            ids_list_str = ', '.join([str(id) for id in ids])
+            sql = """SELECT
+                    id,
+                    aolevel,
+                    displayname,
+                    formalname
+                FROM addrobj%(version_suffix)s
+                WHERE
+                    id in (%(ids_list_str)s)
+                ORDER BY aolevel""" % {
+                    'version_suffix': self.version_suffix,
+                    'ids_list_str': ids_list_str
+                }
+            cur.execute(sql)
+
+        rows = cur.fetchall()
+        cur.close()
+
+        return rows
+
     def get_zip_codes(self, ao_id):
         """Возвращает список почтовых индексов для
         адресного объекта с данным ID."""
         res = []
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        cur1 = self.dbconn.cursor(storage.DictCursor)
 
         sql = """SELECT
                 zc.zip
@@ -63,23 +133,9 @@ class AddressOKGetter:
 
     def get_addr_objects_by_zip_code(self, zip_code):
         """Возвращает адресную информацию по почтовому индексу."""
-        res = {
-            'fill': {
-                'zip': zip_code,
-                'region': {'label': '', 'value': 0},
-                'district': {'label': '', 'value': 0},
-                'place': {'label': '', 'value': 0},
-                'street': {'label': '', 'value': 0},
-            },
-            'suggest': {
-                'region': [],
-                'district': [],
-                'place': [],
-                'street': [],
-            }
-        }
+        res = self._empty_result(zip_code)
 
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        cur1 = self.dbconn.cursor(storage.DictCursor)
 
         aolevels = OrderedDict([
             (1, 'region'),
@@ -96,7 +152,7 @@ class AddressOKGetter:
             'street': [],
         }
 
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        cur1 = self.dbconn.cursor(storage.DictCursor)
         sql = """SELECT
                 ao.id,
                 ao.aolevel,
@@ -128,23 +184,9 @@ class AddressOKGetter:
     def get_initial_addr_objects(self):
         """Возвращает начальную адресную информацию (для инициализации
         формы ввода адреса)."""
-        res = {
-            'fill': {
-                'zip': '',
-                'region': {'label': '', 'value': 0},
-                'district': {'label': '', 'value': 0},
-                'place': {'label': '', 'value': 0},
-                'street': {'label': '', 'value': 0},
-            },
-            'suggest': {
-                'region': [],
-                'district': [],
-                'place': [],
-                'street': [],
-            }
-        }
+        res = self._empty_result()
 
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        cur1 = self.dbconn.cursor(storage.DictCursor)
 
         sql = """SELECT
                 ao.id,
@@ -176,23 +218,9 @@ class AddressOKGetter:
         if ao_id == 0 and zip_code.strip() == '':
             return self.get_initial_addr_objects()
 
-        res = {
-            'fill': {
-                'zip': '',
-                'region': {'label': '', 'value': 0},
-                'district': {'label': '', 'value': 0},
-                'place': {'label': '', 'value': 0},
-                'street': {'label': '', 'value': 0},
-            },
-            'suggest': {
-                'region': [],
-                'district': [],
-                'place': [],
-                'street': [],
-            }
-        }
+        res = self._empty_result()
 
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        cur1 = self.dbconn.cursor(storage.DictCursor)
 
         aolevels = OrderedDict([
             (1, 'region'),
@@ -204,25 +232,8 @@ class AddressOKGetter:
 
         ao_level = 0
 
-        ids = self.get_parent_ids(ao_id)
-        ids.insert(0, ao_id)
-
         # Однозначно заполненные данные
-        ids_list_str = ', '.join([str(id) for id in ids])
-        sql = """SELECT
-                id,
-                aolevel,
-                displayname,
-                formalname
-            FROM addrobj%(version_suffix)s
-            WHERE
-                id in (%(ids_list_str)s)
-            ORDER BY aolevel""" % {
-                'version_suffix': self.version_suffix,
-                'ids_list_str': ids_list_str
-            }
-        cur1.execute(sql)
-        for row in cur1:
+        for row in self._get_fill_rows(ao_id):
             res['fill'][aolevels[row['aolevel']]]['value'] = row['id']
             res['fill'][aolevels[row['aolevel']]]['label'] = row['displayname']
 
@@ -324,6 +335,13 @@ class AddressOKGetter:
 
     def get_addr_objects_raw(self, region_id, district_id, place_id, street_id, zip_code):
         """Возвращает адресные объекты."""
+        ao_id = self.select_ao_id(region_id, district_id, place_id, street_id)
+
+        return self.get_addr_objects(ao_id, zip_code)
+
+    @staticmethod
+    def select_ao_id(region_id, district_id, place_id, street_id):
+        """Возвращает ID самого нижнего из заполненных адресных объектов."""
         ao_id = 0
         if street_id and street_id > 0:
             ao_id = street_id
@@ -334,7 +352,293 @@ class AddressOKGetter:
         elif region_id and region_id > 0:
             ao_id = region_id
 
-        return self.get_addr_objects(ao_id, zip_code)
+        return ao_id
+
+    def get_addr_objects_batch(self, lookups):
+        """Возвращает адресную информацию для списка запросов.
+
+        Аргументы:
+            lookups (list): запросы в виде кортежей ('zip', zip_code)
+                или ('all', ao_id, zip_code).
+
+        Результаты возвращаются в том же порядке, что и запросы.
+        Данные для всех запросов получаются несколькими запросами к БД
+        (по одному на каждый вид данных).
+        """
+        zip_codes = [lookup[1] for lookup in lookups if lookup[0] == 'zip']
+        by_zip = self._get_addr_objects_by_zip_codes(zip_codes)
+
+        pairs = [(lookup[1], lookup[2]) for lookup in lookups if lookup[0] == 'all']
+        by_id = self._get_addr_objects_many(pairs)
+
+        res = []
+        for lookup in lookups:
+            if lookup[0] == 'zip':
+                res.append(by_zip[lookup[1]])
+            else:
+                res.append(by_id[(lookup[1], lookup[2])])
+        return res
+
+    def _sql_list(self, values):
+        """Возвращает экранированный список значений для условия IN (...)."""
+        return ', '.join([self.dbconn.escape(value) for value in values])
+
+    def _get_addr_objects_by_zip_codes(self, zip_codes):
+        """Возвращает словарь с адресной информацией для каждого
+        почтового индекса из списка."""
+        res = {}
+        for zip_code in zip_codes:
+            res[zip_code] = self._empty_result(zip_code)
+        if len(res) == 0:
+            return res
+
+        aolevels = OrderedDict([
+            (1, 'region'),
+            (3, 'district'),
+            (4, 'place'),
+            (6, 'place'),
+            (7, 'street'),
+        ])
+
+        cur1 = self.dbconn.cursor(storage.DictCursor)
+        sql = """SELECT
+                zc.zip,
+                ao.id,
+                ao.aolevel,
+                ao.displayname
+            FROM zipcodes%(version_suffix)s zc
+            INNER JOIN ziplinks%(version_suffix)s zl ON zl.zipid = zc.id
+            INNER JOIN addrobj%(version_suffix)s ao ON zl.aoid = ao.id
+            WHERE
+                zc.zip in (%(zip_codes)s)
+                and aolevel in (1,3,4,6,7)
+            ORDER BY zc.zip, ao.aolevel, ao.formalname""" % {
+                'version_suffix': self.version_suffix,
+                'zip_codes': self._sql_list(res.keys())
+            }
+        cur1.execute(sql)
+        for row in cur1:
+            if row['zip'] not in res:
+                continue
+            res[row['zip']]['suggest'][aolevels[row['aolevel']]].append({
+                'value': row['id'],
+                'label': row['displayname']
+            })
+        cur1.close()
+
+        for item in res.values():
+            for key, items in item['suggest'].items():
+                if len(items) == 1:
+                    item['fill'][key] = item['suggest'][key][0]
+                    item['suggest'][key] = []
+        return res
+
+    def _get_addr_objects_many(self, pairs):
+        """Возвращает словарь с адресной информацией для каждой пары
+        (ID адресного объекта, почтовый индекс) из списка."""
+        res = {}
+        pairs = [pair for pair in set(pairs)]
+
+        # Незаполненная форма
+        initial = [pair for pair in pairs if pair[0] == 0 and pair[1].strip() == '']
+        if len(initial) > 0:
+            initial_res = self.get_initial_addr_objects()
+            for pair in initial:
+                res[pair] = initial_res
+        pairs = [pair for pair in pairs if pair not in res]
+        if len(pairs) == 0:
+            return res
+
+        aolevels = OrderedDict([
+            (1, 'region'),
+            (3, 'district'),
+            (4, 'place'),
+            (6, 'place'),
+            (7, 'street'),
+        ])
+
+        cur1 = self.dbconn.cursor(storage.DictCursor)
+
+        ao_ids = set([ao_id for ao_id, zip_code in pairs])
+
+        # Однозначно заполненные данные (объекты и их предки)
+        fill_rows = {}
+        ao_levels = {}
+        sql = """SELECT
+                p.aoid,
+                ao.id,
+                ao.aolevel,
+                ao.displayname
+            FROM addrpaths%(version_suffix)s p
+            INNER JOIN addrobj%(version_suffix)s ao ON ao.id = p.ancestorid
+            WHERE
+                p.aoid in (%(ao_ids)s)
+            ORDER BY p.aoid, ao.aolevel""" % {
+                'version_suffix': self.version_suffix,
+                'ao_ids': ', '.join([str(ao_id) for ao_id in ao_ids])
+            }
+        try:
+            cur1.execute(sql)
+            rows = cur1.fetchall()
+        except storage.ProgrammingError as err:
+            # если ошибка "Table doesn't exist" (1146), то версия БД
+            # создана без таблицы ADDRPATHS
+            if err.args[0] != 1146:
+                raise
+            rows = []
+            for ao_id in ao_ids:
+                for row in self._get_fill_rows(ao_id):
+                    row['aoid'] = ao_id
+                    rows.append(row)
+        for row in rows:
+            fill_rows.setdefault(row['aoid'], []).append(row)
+            if row['id'] == row['aoid']:
+                ao_levels[row['aoid']] = row['aolevel']
+
+        # ID почтовых индексов
+        zip_ids = {}
+        zip_codes = set([zip_code for ao_id, zip_code in pairs if zip_code.strip() != ''])
+        if len(zip_codes) > 0:
+            sql = """SELECT
+                    id,
+                    zip
+                FROM zipcodes%(version_suffix)s
+                WHERE
+                    zip in (%(zip_codes)s)
+                ORDER BY id""" % {
+                    'version_suffix': self.version_suffix,
+                    'zip_codes': self._sql_list(zip_codes)
+                }
+            cur1.execute(sql)
+            for row in cur1:
+                zip_ids.setdefault(row['zip'], row['id'])
+
+        # Дочерние объекты для подсказок
+        children = {}
+        parent_ids = [ao_id for ao_id in ao_ids if ao_levels.get(ao_id) in (1, 3, 4, 6)]
+        if len(parent_ids) > 0:
+            sql = """SELECT
+                    id,
+                    parentid,
+                    aolevel,
+                    displayname
+                FROM addrobj%(version_suffix)s ao
+                WHERE
+                    ao.parentid in (%(parent_ids)s)
+                    and ao.aolevel in (1,3,4,6,7)
+                ORDER BY ao.formalname""" % {
+                    'version_suffix': self.version_suffix,
+                    'parent_ids': ', '.join([str(ao_id) for ao_id in parent_ids])
+                }
+            cur1.execute(sql)
+            for row in cur1:
+                children.setdefault(row['parentid'], []).append(row)
+
+        # Связи дочерних объектов с почтовыми индексами
+        child_zip_links = set()
+        if len(parent_ids) > 0 and len(zip_ids) > 0:
+            sql = """SELECT
+                    zl.zipid,
+                    zl.aoid
+                FROM ziplinks%(version_suffix)s zl
+                INNER JOIN addrobj%(version_suffix)s ao ON ao.id = zl.aoid
+                WHERE
+                    ao.parentid in (%(parent_ids)s)
+                    and zl.zipid in (%(zip_ids)s)""" % {
+                    'version_suffix': self.version_suffix,
+                    'parent_ids': ', '.join([str(ao_id) for ao_id in parent_ids]),
+                    'zip_ids': ', '.join([str(zip_id) for zip_id in zip_ids.values()])
+                }
+            cur1.execute(sql)
+            for row in cur1:
+                child_zip_links.add((row['zipid'], row['aoid']))
+
+        # Почтовые индексы адресных объектов
+        ao_zip_codes = {}
+        blank_zip_ids = [ao_id for ao_id, zip_code in pairs if zip_code.strip() == '']
+        if len(blank_zip_ids) > 0:
+            sql = """SELECT
+                    zl.aoid,
+                    zc.zip
+                FROM ziplinks%(version_suffix)s zl
+                INNER JOIN zipcodes%(version_suffix)s zc ON zl.zipid = zc.id
+                WHERE
+                    zl.aoid in (%(ao_ids)s)""" % {
+                    'version_suffix': self.version_suffix,
+                    'ao_ids': ', '.join([str(ao_id) for ao_id in set(blank_zip_ids)])
+                }
+            cur1.execute(sql)
+            for row in cur1:
+                ao_zip_codes.setdefault(row['aoid'], []).append(row['zip'])
+
+        cur1.close()
+
+        for ao_id, zip_code in pairs:
+            item = self._empty_result()
+
+            for row in fill_rows.get(ao_id, []):
+                item['fill'][aolevels[row['aolevel']]]['value'] = row['id']
+                item['fill'][aolevels[row['aolevel']]]['label'] = row['displayname']
+
+            zip_id = zip_ids.get(zip_code, 0)
+            for row in children.get(ao_id, []):
+                if zip_id > 0 and (zip_id, row['id']) not in child_zip_links:
+                    continue
+                item['suggest'][aolevels[row['aolevel']]].append(
+                    {'value': row['id'], 'label': row['displayname']})
+
+            if zip_code.strip() == '':
+                zip_codes = ao_zip_codes.get(ao_id, [])
+                # Если почтовый индекс один, заполняем его
+                if len(zip_codes) == 1:
+                    item['fill']['zip'] = zip_codes[0]
+            else:
+                item['fill']['zip'] = zip_code
+
+            res[(ao_id, zip_code)] = item
+
+        return res
+
+    def search_addr_objects(self, parent_id, field, prefix, limit):
+        """Возвращает адресные объекты поля формы field, дочерние
+        для объекта parent_id, наименования которых начинаются с prefix."""
+        res = {'suggest': []}
+
+        aolevels = {
+            'region': (1,),
+            'district': (3,),
+            'place': (4, 6),
+            'street': (7,),
+        }
+        if field not in aolevels:
+            return res
+
+        # Экранируем спецсимволы LIKE
+        like = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')+'%'
+
+        cur1 = self.dbconn.cursor(storage.DictCursor)
+        sql = """SELECT
+                id,
+                displayname
+            FROM addrobj%(version_suffix)s ao
+            WHERE
+                ao.parentid = %(parent_id)s
+                and ao.aolevel in (%(aolevels_str)s)
+                and ao.formalname like %(like)s
+            ORDER BY ao.formalname
+            LIMIT %(limit)s""" % {
+                'version_suffix': self.version_suffix,
+                'parent_id': int(parent_id),
+                'aolevels_str': ', '.join([str(l) for l in aolevels[field]]),
+                'like': self.dbconn.escape(like),
+                'limit': int(limit),
+            }
+        cur1.execute(sql)
+        for row in cur1:
+            res['suggest'].append({'value': row['id'], 'label': row['displayname']})
+        cur1.close()
+
+        return res
 
     # ToDo: remove this
     def get_password_hash(self, password, salt):
@@ -352,7 +656,7 @@ class AddressOKGetter:
         """Returns True, if password is correct, False otherwise.
         Returns None, if such user is not found in the DB."""
         res = ''
-        cur = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        cur = self.dbconn.cursor(storage.DictCursor)
         sql = """SELECT password_salt, password_hash, request_count FROM accounts
             WHERE username = '%(username)s'""" % {'username': user}
         cur.execute(sql)
@@ -376,7 +680,7 @@ class AddressOKGetter:
         """Returns True, if password is correct, False otherwise.
         Returns None, if such user is not found in the DB."""
         res = ''
-        cur = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        cur = self.dbconn.cursor(storage.DictCursor)
         sql = """SELECT password, request_count FROM accounts
             WHERE username = '%(username)s'""" % {'username': user}
         cur.execute(sql)
@@ -1,11 +1,22 @@
 """Этот скрипт производит начальную инициализацию БД и должен быть
 выполнен один раз."""
-import os
-import pymysql
+import os, argparse
 import initializer
+import storage
+import conf
 
-db = pymysql.connect(host='mysql', user='addressok', passwd='123',
-    db='addressok', port=3306, charset='utf8')
+parser = argparse.ArgumentParser(description='Начальная инициализация БД.')
+parser.add_argument('--regions',
+    help='коды загружаемых регионов через запятую (по умолчанию conf.regions)')
+args = parser.parse_args()
+# Коды загружаемых регионов (None -- все регионы)
+regions = args.regions.split(',') if args.regions else conf.regions
+
+# Соединение с БД, заданной в conf (MySQL или файл SQLite, см.
+# conf.db_engine)
+connect = storage.connect
+
+db = connect()
 
 # Папка для XML с исходными данными
 xmldir = '/data/srcxml'
@@ -19,20 +30,22 @@ for fname in os.listdir(xmldir):
     elif fname.lower().startswith('as_socrbase_') and fname.lower().endswith('.xml'):
         socrbase_file = fname
 
-init = initializer.AddressOKInitializer(db, 1)
-init.create_tables()
-init.load_address_objects(os.path.join(xmldir, addrobj_file))
-init.load_socr(os.path.join(xmldir, socrbase_file))
-init.fill_parent_ids()
-init.fill_zip_codes()
-init.fill_zip_links()
-init.fill_socr_codes()
-init.fill_socr_names()
-init.fill_addrobj_socr()
-init.fill_socr_diplaynames()
-init.fill_good_names()
-
-cur = db.cursor(pymysql.cursors.DictCursor)
+init = initializer.AddressOKInitializer(db, 1, connect=connect, regions=regions)
+init.build(os.path.join(xmldir, addrobj_file), os.path.join(xmldir, socrbase_file),
+    mode=conf.build_mode, processes=conf.build_processes,
+    defer_indexes=conf.defer_indexes, index_dir=conf.index_dir,
+    report_file=conf.build_report_file % 1)
+
+cur = db.cursor(storage.DictCursor)
+
+cur.execute("""CREATE TABLE IF NOT EXISTS options (
+        id INTEGER NOT NULL AUTO_INCREMENT,
+
+        db_version INTEGER DEFAULT 0,
+        fias_ver_date TEXT,
+
+        PRIMARY KEY(id)
+    )""")
 
 # Вставляем начальные данные в таблицу OPTIONS
 sql = "DELETE FROM options"
@@ -43,4 +56,7 @@ db.commit()
 
 cur.close()
 
+# Сборка завершена
+init.reset_build_state()
+
 db.close()
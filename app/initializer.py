@@ -1,6 +1,357 @@
+import io, os, time, json, uuid, resource, multiprocessing
+from collections import OrderedDict, deque
 from lxml import etree
-import pymysql
+import storage
 import gnm
+import zipindex
+
+# Кол-во повторов порции записей, отменённой из-за взаимной блокировки
+# или истечения времени ожидания блокировки (см. _update_column)
+LOCK_RETRIES = 5
+
+# Вторичные индексы таблиц (поля, по которым строятся индексы;
+# составной индекс задаётся кортежем полей). При загрузке с отложенным
+# созданием индексов (см. create_tables) они создаются методом
+# create_indexes после заполнения таблиц.
+INDEXES = OrderedDict([
+    ('addrobj', ['parentid', 'zipid', 'socrcode', 'aoguid', 'postalcode',
+        'shortname', 'aolevel', 'regioncode',
+        # Поиск дочерних объектов по началу наименования (см.
+        # AddressOKGetter.search_addr_objects)
+        ('parentid', 'aolevel', 'formalname')]),
+    ('socrbase', ['code', 'level', 'scname', 'socrname', 'kod_t_st']),
+    ('zipcodes', ['zip']),
+    ('ziplinks', ['zipid', 'aoid']),
+])
+
+
+def _index_columns(index):
+    """Возвращает поля индекса из INDEXES."""
+    return (index,) if isinstance(index, str) else tuple(index)
+
+
+def _index_name(index):
+    """Возвращает имя индекса из INDEXES (для индекса по одному полю --
+    имя поля)."""
+    return '_'.join(_index_columns(index))
+
+
+# Отображаемые сокращения (по целочисленным кодам).
+# Свойство 'type' обозначает тип сокращения:
+# 'dot' -- пишется с точкой в конце ("г.", "ул." и т.д.)
+# 'upper' -- пишется большими буквами ("СНТ", "ДНП" и т.д.)
+SOCR_DISPLAY_NAMES = {
+    102: {'name': 'АО', 'scname': 'Аобл'},
+    103: {'type': 'dot', 'scname': 'г'},
+    105: {'type': 'dot', 'scname': 'обл'},
+    106: {'name': 'респ.', 'scname': 'Респ'},
+    306: {'type': 'dot', 'scname': 'п'},
+    303: {'type': 'dot', 'scname': 'тер'},
+    302: {'type': 'dot', 'scname': 'у'},
+    401: {'type': 'dot', 'scname': 'г'},
+    405: {'type': 'upper', 'scname': 'дп'},
+    404: {'type': 'upper', 'scname': 'кп'},
+    417: {'type': 'dot', 'scname': 'п'},
+    412: {'type': 'dot', 'scname': 'тер'},
+    502: {'type': 'dot', 'scname': 'тер'},
+    604: {'type': 'dot', 'scname': 'высел'},
+    605: {'type': 'dot', 'scname': 'г'},
+    606: {'type': 'dot', 'scname': 'д'},
+    617: {'type': 'dot', 'scname': 'м'},
+    621: {'type': 'dot', 'scname': 'п'},
+    630: {'type': 'dot', 'scname': 'с'},
+    631: {'type': 'dot', 'scname': 'сл'},
+    641: {'type': 'upper', 'scname': 'снт'},
+    632: {'type': 'dot', 'scname': 'ст'},
+    637: {'type': 'dot', 'scname': 'тер'},
+    634: {'type': 'dot', 'scname': 'у'},
+    635: {'type': 'dot', 'scname': 'х'},
+    #734: {'type': 'dot', 'scname': 'высел'},
+    763: {'type': 'upper', 'scname': 'гск'},
+    736: {'type': 'dot', 'scname': 'д'},
+    787: {'type': 'upper', 'scname': 'днп'},
+    704: {'type': 'dot', 'scname': 'дор'},
+    744: {'type': 'dot', 'scname': 'м'},
+    711: {'type': 'dot', 'scname': 'наб'},
+    714: {'type': 'dot', 'scname': 'пер'},
+    9114: {'type': 'dot', 'scname': 'пер'},
+    716: {'type': 'dot', 'scname': 'пл'},
+    747: {'type': 'dot', 'scname': 'платф'},
+    755: {'type': 'dot', 'scname': 'с'},
+    756: {'type': 'dot', 'scname': 'сл'},
+    757: {'type': 'dot', 'scname': 'ст'},
+    725: {'type': 'dot', 'scname': 'стр'},
+    726: {'type': 'dot', 'scname': 'тер'},
+    728: {'type': 'dot', 'scname': 'туп'},
+    729: {'type': 'dot', 'scname': 'ул'},
+    9129: {'type': 'dot', 'scname': 'ул'},
+    758: {'type': 'dot', 'scname': 'х'},
+    731: {'type': 'dot', 'scname': 'ш'},
+}
+
+
+
+def _socr_displayname(code, scname):
+    """Возвращает отображаемое сокращение ("г.", "СНТ" и т.д.)."""
+    dn = SOCR_DISPLAY_NAMES
+    displayname = scname
+    if code in dn.keys():
+        if scname != dn[code]['scname']:
+            print(code)
+            print(scname.encode('utf-8'))
+            print(dn[code]['scname'].encode('utf-8'))
+        assert scname == dn[code]['scname']
+
+        if 'type' in dn[code].keys():
+            socrtype = dn[code]['type']
+            if socrtype == 'dot':
+                displayname = scname+'.'
+            elif socrtype == 'upper':
+                displayname = scname.upper()
+        if 'name' in dn[code].keys():
+            displayname = dn[code]['name']
+    return displayname
+
+
+def _socr_row(element):
+    """Возвращает значения полей таблицы SOCRBASE для XML-элемента
+    сокращения (в порядке level, scname, socrname, kod_t_st, code,
+    name, displayname)."""
+    scname = element.get('SCNAME')
+    socrname = element.get('SOCRNAME')
+    kod_t_st = element.get('KOD_T_ST')
+    code = int(kod_t_st) if kod_t_st is not None else 0
+    return (
+        element.get('LEVEL'),
+        scname,
+        socrname,
+        kod_t_st,
+        code,
+        socrname.lower() if socrname is not None else '',
+        _socr_displayname(code, scname),
+    )
+
+
+# Объект для вычисления отображаемых имён (в процессах пула)
+_names_maker = None
+
+
+def _make_good_names(rows):
+    """Возвращает пары (ID адресного объекта, отображаемое имя)
+    для списка записей."""
+    global _names_maker
+    if _names_maker is None:
+        _names_maker = gnm.GoodNamesMaker()
+    return [(row['id'], _names_maker.make_good_name(row)) for row in rows]
+
+
+def _guid_bytes(guid):
+    """Возвращает GUID в виде 16 байт для полей BINARY(16) (None, если
+    GUID не задан)."""
+    if not guid:
+        return None
+    return uuid.UUID(guid).bytes
+
+
+def _addrobj_row(element):
+    """Возвращает значения полей таблицы ADDROBJ для XML-элемента
+    адресного объекта (в порядке aoguid, formalname, offname,
+    postalcode, shortname, aolevel, parentguid, regioncode).
+    GUID'ы возвращаются в виде байтов (см. _guid_bytes)."""
+    return (
+        _guid_bytes(element.get('AOGUID')),
+        element.get('FORMALNAME'),
+        element.get('OFFNAME'),
+        element.get('POSTALCODE'),
+        element.get('SHORTNAME'),
+        element.get('AOLEVEL'),
+        _guid_bytes(element.get('PARENTGUID')),
+        element.get('REGIONCODE'),
+    )
+
+
+def _region_set(regions):
+    """Возвращает множество двузначных кодов регионов (или None, если
+    загружаются все регионы)."""
+    if regions is None:
+        return None
+    return frozenset(str(code).strip().zfill(2) for code in regions)
+
+
+def _is_loaded(element, regions=None):
+    """Проверяет, загружается ли XML-элемент адресного объекта: объект
+    должен быть действующим и относиться к одному из регионов regions
+    (None -- к любому региону)."""
+    if element.get('LIVESTATUS') != '1' or element.get('ACTSTATUS') != '1':
+        return False
+    return regions is None or element.get('REGIONCODE') in regions
+
+
+def _iterparse(source, **kwargs):
+    """Разбирает XML-файл (как etree.iterparse). Вместо имени файла
+    можно передать объект с методом open(), возвращающим поток
+    (например, rarstream.RarMember)."""
+    if isinstance(source, str):
+        for item in etree.iterparse(source, **kwargs):
+            yield item
+    else:
+        with source.open() as f:
+            for item in etree.iterparse(f, **kwargs):
+                yield item
+
+
+def _parse_processes(source, processes):
+    """Возвращает кол-во процессов для разбора XML-файла source. Поток
+    (см. _iterparse) нельзя разбить на части, он разбирается в одном
+    процессе."""
+    if processes > 1 and not isinstance(source, str):
+        print('Warning: %s is read from the archive and is parsed in a single process'
+            ' (see conf.stream_from_archive).' % source)
+        return 1
+    return processes
+
+
+def _split_xml_file(fname, chunk_size, tag=b'<Object '):
+    """Разбивает XML-файл на диапазоны байтов (начало, конец), каждый
+    из которых содержит целое число элементов tag (без корневого
+    элемента)."""
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        head = f.read(1024*1024)
+        start = head.find(tag)
+        if start < 0:
+            return []
+
+        # Конец последнего элемента -- начало закрывающего тега
+        # корневого элемента
+        tail_start = max(start, size - 1024*1024)
+        f.seek(tail_start)
+        end = tail_start + f.read().rfind(b'</')
+
+        bounds = [start]
+        pos = start + chunk_size
+        while pos < end:
+            f.seek(pos)
+            buf = f.read(1024*1024)
+            if len(buf) == 0:
+                break
+            found = buf.find(tag)
+            if found < 0:
+                # Длина буфера меньше тега -- ищем с перекрытием
+                pos += max(len(buf) - len(tag), 1)
+                continue
+            if pos + found >= end:
+                break
+            bounds.append(pos + found)
+            pos = pos + found + chunk_size
+        bounds.append(end)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _parse_addrobj_chunk(args):
+    """Разбирает диапазон байтов файла с адресными объектами. Возвращает
+    кол-во разобранных элементов и строки для таблицы ADDROBJ."""
+    fname, start, end, regions = args
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    rows = []
+    cnt = 0
+    source = io.BytesIO(b'<AddressObjects>' + data + b'</AddressObjects>')
+    for event, element in etree.iterparse(source, events=('end',), tag='Object'):
+        if _is_loaded(element, regions):
+            rows.append(_addrobj_row(element))
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        cnt += 1
+
+    return cnt, rows
+
+
+def _socr_key(scname):
+    """Возвращает ключ сокращения для сравнения (без учёта регистра
+    и завершающих пробелов, как при сравнении строк в MySQL)."""
+    return scname.rstrip().lower().replace('ё', 'е')
+
+
+def _good_name_row(ao_id, row, socr, socr_codes):
+    """Возвращает код сокращения адресного объекта и запись для
+    вычисления его отображаемого имени (None, если сокращение
+    не найдено).
+
+    Аргументы:
+        row: строка для таблицы ADDROBJ (см. _addrobj_row).
+        socr: сокращения по кодам (см. _load_socr_codes).
+        socr_codes: коды сокращений (см. _load_socr_level_codes).
+    """
+    aoguid, formalname, offname, postalcode, shortname, \
+        aolevel, parentguid, regioncode = row
+    aolevel = int(aolevel) if aolevel is not None else None
+
+    socrcode = 0
+    if aolevel not in (90, 91) and shortname is not None:
+        socrcode = socr_codes.get((aolevel, _socr_key(shortname)), 0)
+    if socrcode == 0:
+        return 0, None
+
+    names_row = {
+        'id': ao_id,
+        'formalname': formalname,
+        'socrcode': socrcode,
+        'aolevel': aolevel,
+        'regioncode': regioncode,
+    }
+    names_row.update(socr[socrcode])
+    return socrcode, names_row
+
+
+def _addr_paths(ao_id, parents):
+    """Возвращает строки ADDRPATHS (ID объекта, ID предка, глубина)
+    для адресного объекта и всех его предков."""
+    rows = []
+    ancestor_id = ao_id
+    depth = 0
+    while ancestor_id != 0 and ancestor_id in parents:
+        rows.append((ao_id, ancestor_id, depth))
+        ancestor_id = parents[ancestor_id]
+        depth += 1
+    return rows
+
+
+def _zip_links(zip_id, ao_ids, parents):
+    """Возвращает строки ZIPLINKS (ID почтового индекса, ID объекта)
+    для адресных объектов с почтовым индексом и всех их предков."""
+    linked = set()
+    for ao_id in ao_ids:
+        while ao_id != 0 and ao_id not in linked and ao_id in parents:
+            linked.add(ao_id)
+            ao_id = parents[ao_id]
+    return [(zip_id, ao_id) for ao_id in sorted(linked)]
+
+
+def _fill_region(args):
+    """Заполняет поля и таблицы, зависящие от иерархии адресных
+    объектов, для одного региона (в процессе пула, со своим
+    соединением с БД). Возвращает код региона и кол-во выполненных
+    процессом запросов к БД."""
+    connect, version, regioncode = args
+    dbconn = connect()
+    try:
+        init = AddressOKInitializer(dbconn, version)
+        init.fill_parent_ids(regioncode=regioncode)
+        init.fill_addr_paths(regioncode=regioncode)
+        init.fill_zip_links(regioncode=regioncode)
+        init.fill_addrobj_socr(regioncode=regioncode)
+        init.fill_good_names(processes=1, regioncode=regioncode)
+        dbconn.commit()
+        # Запрос SHOW STATUS тоже учитывается в счётчике
+        statements = init._get_statement_count() - 1
+    finally:
+        dbconn.close()
+    return regioncode, statements
 
 
 class AddressOKInitializer:
@@ -10,15 +361,62 @@ class AddressOKInitializer:
     объектов и т.д..
     """
 
-    def __init__(self, dbconn, version_num):
+    def __init__(self, dbconn, version_num, connect=None, regions=None):
         self.dbconn = dbconn
+        # Функция, создающая новое соединение с БД (для процессов,
+        # обрабатывающих регионы, см. fill_regions)
+        self.connect = connect
         # Номер версии БД (при каждом обновлении увеличивается на 1)
         self.version = version_num
         # Суффикс для названий таблиц
         self.version_suffix = '_v'+str(version_num)
+        # Коды регионов, адресные объекты которых загружаются в БД
+        # (None -- все регионы). Остальные таблицы заполняются по
+        # загруженным адресным объектам
+        self.regions = _region_set(regions)
+        # Исходные данные сборки и завершённые этапы сборки (см. build)
+        self.source = ''
+        self.finished_stages = set()
+        # Функция, которой передаётся ход выполнения этапов сборки:
+        # progress(этап, кол-во обработанных строк, всего строк или None)
+        self.progress = None
+        # Текущий этап сборки, кол-во обработанных в нём строк
+        # и запросов к БД, выполненных другими соединениями
+        self.stage = None
+        self.stage_rows = 0
+        self.stage_statements = 0
+        # Показатели выполненных этапов сборки (см. run_stage)
+        self.metrics = []
+        # Сокращения, загруженные методом load_socr (см. _get_socr)
+        self.socr = None
+        self.socr_codes = None
     
-    def create_tables(self):
-        """Создаёт таблицы в БД."""
+    def _progress(self, message, cnt, cnt_all=None):
+        """Выводит ход выполнения этапа сборки и передаёт его функции
+        self.progress (если она задана)."""
+        if cnt_all is None:
+            print(message, cnt)
+        else:
+            print('%s %s / %s' % (message, cnt, cnt_all))
+        self.stage_rows = cnt
+        if self.progress is not None:
+            self.progress(self.stage, cnt, cnt_all)
+
+    def _index_definitions(self, table, defer_indexes):
+        """Возвращает описания вторичных индексов таблицы для CREATE TABLE
+        (пустую строку, если создание индексов отложено)."""
+        if defer_indexes:
+            return ''
+        return ''.join([',\n                INDEX %s (%s)' % (_index_name(index),
+            ', '.join(_index_columns(index))) for index in INDEXES[table]])
+
+    def create_tables(self, defer_indexes=False):
+        """Создаёт таблицы в БД.
+
+        Если defer_indexes=True, таблицы создаются только с первичными
+        ключами, а вторичные индексы нужно создать методом create_indexes
+        после заполнения таблиц.
+        """
 
         cur = self.dbconn.cursor()
 
@@ -31,25 +429,20 @@ class AddressOKInitializer:
                 zipid INTEGER DEFAULT 0,
                 socrcode INTEGER(5) DEFAULT 0,
                 displayname VARCHAR(200) DEFAULT '',
-                aoguid VARCHAR(36),
+                aoguid BINARY(16),
                 formalname VARCHAR(120),
                 offname VARCHAR(120),
                 postalcode VARCHAR(6),
                 shortname VARCHAR(10),
                 aolevel INTEGER(10),
-                parentguid VARCHAR(36),
+                parentguid BINARY(16),
                 regioncode VARCHAR(2),
 
-                PRIMARY KEY(id),
-                INDEX(parentid),
-                INDEX(zipid),
-                INDEX(socrcode),
-                KEY(aoguid),
-                INDEX(postalcode),
-                KEY(shortname),
-                KEY(aolevel),
-                KEY(parentguid)
-            );""" % {'version_suffix': self.version_suffix}
+                PRIMARY KEY(id)%(indexes)s
+            );""" % {
+                'version_suffix': self.version_suffix,
+                'indexes': self._index_definitions('addrobj', defer_indexes),
+            }
         cur.execute(sql)
         
         # Таблица, содержащая сокращения
@@ -65,13 +458,11 @@ class AddressOKInitializer:
                 socrname VARCHAR(50),
                 kod_t_st VARCHAR(4),
 
-                PRIMARY KEY(id),
-                INDEX(code),
-                INDEX(level),
-                INDEX(scname),
-                INDEX(socrname),
-                KEY(kod_t_st)
-            );""" % {'version_suffix': self.version_suffix}
+                PRIMARY KEY(id)%(indexes)s
+            );""" % {
+                'version_suffix': self.version_suffix,
+                'indexes': self._index_definitions('socrbase', defer_indexes),
+            }
         cur.execute(sql)
         
         # Таблица со списком почтовых индексов
@@ -81,9 +472,11 @@ class AddressOKInitializer:
 
                 zip VARCHAR(6),
 
-                PRIMARY KEY(id),
-                INDEX(zip)
-            );""" % {'version_suffix': self.version_suffix}
+                PRIMARY KEY(id)%(indexes)s
+            );""" % {
+                'version_suffix': self.version_suffix,
+                'indexes': self._index_definitions('zipcodes', defer_indexes),
+            }
         cur.execute(sql)
         
         # Таблица соответствия почтовых индексов адресным объектам
@@ -94,14 +487,75 @@ class AddressOKInitializer:
                 zipid INTEGER,
                 aoid BIGINT,
 
-                PRIMARY KEY(id),
-                INDEX(zipid),
-                INDEX(aoid)
+                PRIMARY KEY(id)%(indexes)s
+            );""" % {
+                'version_suffix': self.version_suffix,
+                'indexes': self._index_definitions('ziplinks', defer_indexes),
+            }
+        cur.execute(sql)
+
+        # Таблица путей от адресных объектов к их предкам (включая
+        # сам объект с глубиной 0)
+        cur.execute("DROP TABLE IF EXISTS addrpaths"+self.version_suffix)
+        sql = """CREATE TABLE IF NOT EXISTS addrpaths%(version_suffix)s (
+                aoid BIGINT NOT NULL,
+                ancestorid BIGINT NOT NULL,
+                depth INTEGER DEFAULT 0,
+
+                PRIMARY KEY(aoid, ancestorid)
             );""" % {'version_suffix': self.version_suffix}
         cur.execute(sql)
         
         cur.close()
 
+    def create_indexes(self):
+        """Создаёт вторичные индексы таблиц (уже существующие индексы
+        пропускаются). Возвращает список (таблица, имя индекса, время
+        создания индекса в секундах)."""
+        res = []
+        for table, indexes in INDEXES.items():
+            for index in indexes:
+                seconds = self._create_index(table, index)
+                if seconds is not None:
+                    res.append((table, _index_name(index), seconds))
+        return res
+
+    def _create_index(self, table, index):
+        """Создаёт индекс по полю (или кортежу полей) таблицы, если его нет.
+        Возвращает время создания индекса в секундах (или None, если индекс
+        уже есть)."""
+        cur = self.dbconn.cursor()
+        cur.execute("SHOW INDEX FROM %(table)s%(version_suffix)s WHERE Key_name = '%(name)s'" % {
+            'version_suffix': self.version_suffix,
+            'table': table,
+            'name': _index_name(index),
+        })
+        if len(cur.fetchall()) > 0:
+            cur.close()
+            return None
+
+        t1 = time.time()
+        cur.execute("ALTER TABLE %(table)s%(version_suffix)s ADD INDEX %(name)s (%(columns)s)" % {
+            'version_suffix': self.version_suffix,
+            'table': table,
+            'name': _index_name(index),
+            'columns': ', '.join(_index_columns(index)),
+        })
+        seconds = time.time() - t1
+        cur.close()
+        print('Creating index %s(%s). %.1f s' % (table+self.version_suffix,
+            ', '.join(_index_columns(index)), seconds))
+        return seconds
+
+    def _region_condition(self, regioncode):
+        """Возвращает условие отбора адресных объектов региона для WHERE
+        (None -- все объекты, '' -- объекты без кода региона)."""
+        if regioncode is None:
+            return '1 = 1'
+        if regioncode == '':
+            return "(regioncode IS NULL or regioncode = '')"
+        return 'regioncode = %s' % self.dbconn.escape(regioncode)
+
     def _clear_address_objects(self):
         cur = self.dbconn.cursor()
         cur.execute('TRUNCATE TABLE addrobj'+self.version_suffix)
@@ -112,35 +566,46 @@ class AddressOKInitializer:
         cur.execute('TRUNCATE TABLE socrbase'+self.version_suffix)
         cur.close()
 
-    def load_address_objects(self, fname):
-        """Загружает адресные объекты из файла в таблицу ADDOBJ."""
+    def _tune_session_for_bulk_load(self):
+        """Настраивает сессию БД для массовой загрузки данных."""
+        cur = self.dbconn.cursor()
+        cur.execute("SET SESSION unique_checks = 0")
+        cur.execute("SET SESSION foreign_key_checks = 0")
+        cur.close()
+
+    def load_address_objects(self, fname, step=10000, processes=1,
+            chunk_size=32*1024*1024):
+        """Загружает адресные объекты из файла в таблицу ADDOBJ.
+
+        Если processes больше 1, файл разбивается на части по chunk_size
+        байт, которые разбираются в пуле из processes процессов (строки
+        вставляются в порядке следования в файле). Поток (см. _iterparse)
+        разбирается в одном процессе.
+        """
         self._clear_address_objects()
+        self._tune_session_for_bulk_load()
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = _parse_processes(fname, processes)
+        if processes > 1:
+            self._load_address_objects_parallel(fname, step, processes, chunk_size)
+            return
 
         cur = self.dbconn.cursor()
 
+        sql = """INSERT INTO addrobj%(version_suffix)s (aoguid, formalname, offname,
+                postalcode, shortname,
+                aolevel, parentguid, regioncode)
+            VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)""" % {
+                'version_suffix': self.version_suffix
+            }
+        rows = []
         cnt = 0
 
-        for event, element in etree.iterparse(fname, events=('end',)):
-            if element.get('LIVESTATUS') == '1' and element.get('ACTSTATUS') == '1':
-                sql = """INSERT INTO addrobj%(version_suffix)s (aoguid, formalname, offname,
-                        postalcode, shortname,
-                        aolevel, parentguid, regioncode)
-                    VALUES ('%(AOGUID)s', '%(FORMALNAME)s', '%(OFFNAME)s',
-                        '%(POSTALCODE)s', '%(SHORTNAME)s',
-                        %(AOLEVEL)s, '%(PARENTGUID)s', '%(REGIONCODE)s')""" % {
-                            'version_suffix': self.version_suffix,
-                            'AOGUID': element.get('AOGUID'),
-                            'FORMALNAME': element.get('FORMALNAME').replace("'", "''")\
-                                if element.get('FORMALNAME') is not None else None,
-                            'OFFNAME': element.get('OFFNAME').replace("'", "''")\
-                                if element.get('OFFNAME') is not None else None,
-                            'POSTALCODE': element.get('POSTALCODE'),
-                            'SHORTNAME': element.get('SHORTNAME'),
-                            'AOLEVEL': element.get('AOLEVEL'),
-                            'PARENTGUID': element.get('PARENTGUID'),
-                            'REGIONCODE': element.get('REGIONCODE'),
-                        }
-                cur.execute(sql)
+        for event, element in _iterparse(fname, events=('end',)):
+            if _is_loaded(element, self.regions):
+                rows.append(_addrobj_row(element))
 
             while element.getprevious() is not None:
                 del element.getparent()[0]
@@ -148,36 +613,239 @@ class AddressOKInitializer:
             element.clear()
 
             cnt += 1
-            if cnt % 1000 == 0:
+            if cnt % step == 0:
+                cur.executemany(sql, rows)
+                rows = []
                 self.dbconn.commit()
-                print("Loading data into ADDROBJ.", cnt)
+                self._progress("Loading data into ADDROBJ.", cnt)
 
-        if cnt % 1000 != 0:
-            print("Loading data into ADDROBJ.", cnt)
+        if len(rows) > 0:
+            cur.executemany(sql, rows)
+        if cnt % step != 0:
+            self._progress("Loading data into ADDROBJ.", cnt)
         
         self.dbconn.commit()
 
         cur.close()
 
-    def load_socr(self, fname):
-        """Загружает сокращения из файла в таблицу SOCRBASE."""
+    def _load_address_objects_parallel(self, fname, step, processes, chunk_size):
+        """Загружает адресные объекты, разбирая файл в пуле процессов."""
+        cur = self.dbconn.cursor()
+
+        sql = """INSERT INTO addrobj%(version_suffix)s (aoguid, formalname, offname,
+                postalcode, shortname,
+                aolevel, parentguid, regioncode)
+            VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)""" % {
+                'version_suffix': self.version_suffix
+            }
+
+        chunks = [(fname, start, end, self.regions)
+            for start, end in _split_xml_file(fname, chunk_size)]
+        print("Loading data into ADDROBJ. Chunks: %s, processes: %s" % (len(chunks), processes))
+
+        pool = multiprocessing.Pool(processes)
+        # Части, отправленные в пул и ещё не записанные в БД
+        pending = deque()
+        cnt = 0
+        try:
+            for chunk in chunks:
+                pending.append(pool.apply_async(_parse_addrobj_chunk, (chunk,)))
+                # Записываем части по порядку, оставляя в пуле
+                # не больше двух частей на процесс
+                while len(pending) >= processes * 2:
+                    cnt += self._insert_address_objects(cur, sql, pending.popleft().get(), step)
+                    self._progress("Loading data into ADDROBJ.", cnt)
+            while len(pending) > 0:
+                cnt += self._insert_address_objects(cur, sql, pending.popleft().get(), step)
+                self._progress("Loading data into ADDROBJ.", cnt)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        cur.close()
+
+    def _insert_address_objects(self, cur, sql, chunk, step):
+        """Вставляет разобранную часть файла в таблицу ADDROBJ и
+        возвращает кол-во разобранных в ней элементов."""
+        cnt, rows = chunk
+        for i in range(0, len(rows), step):
+            cur.executemany(sql, rows[i:i + step])
+            self.dbconn.commit()
+        return cnt
+
+    def _read_address_objects(self, fname, step, processes, chunk_size):
+        """Читает действующие адресные объекты из файла и возвращает
+        список строк для таблицы ADDROBJ (в порядке следования в файле)."""
+        rows = []
+        cnt = 0
+
+        if _parse_processes(fname, processes) > 1:
+            chunks = [(fname, start, end, self.regions)
+            for start, end in _split_xml_file(fname, chunk_size)]
+            print("Reading ADDROBJ. Chunks: %s, processes: %s" % (len(chunks), processes))
+            pool = multiprocessing.Pool(processes)
+            try:
+                for chunk_cnt, chunk_rows in pool.imap(_parse_addrobj_chunk, chunks):
+                    rows.extend(chunk_rows)
+                    cnt += chunk_cnt
+                    self._progress("Reading ADDROBJ.", cnt)
+            finally:
+                pool.terminate()
+                pool.join()
+            return rows
+
+        for event, element in _iterparse(fname, events=('end',)):
+            if _is_loaded(element, self.regions):
+                rows.append(_addrobj_row(element))
+
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+            element.clear()
+
+            cnt += 1
+            if cnt % step == 0:
+                self._progress("Reading ADDROBJ.", cnt)
+
+        if cnt % step != 0:
+            self._progress("Reading ADDROBJ.", cnt)
+        return rows
+
+    def load_address_objects_single_pass(self, fname, socr_fname, step=10000,
+            processes=1, chunk_size=32*1024*1024):
+        """Загружает сокращения и адресные объекты, записывая каждую
+        строку таблицы ADDROBJ один раз.
+
+        Заменяет load_address_objects, load_socr, fill_parent_ids,
+        fill_addrobj_socr и fill_good_names: сокращения загружаются
+        первыми, файл с адресными объектами читается один раз, а поля
+        PARENTID, SOCRCODE и DISPLAYNAME вычисляются в памяти. ID
+        адресных объектов совпадают с ID, которые получились бы при
+        загрузке load_address_objects. Отображаемые имена вычисляются
+        в пуле из processes процессов.
+        """
+        # Сокращения
+        self.load_socr(socr_fname)
+        socr, socr_codes = self._get_socr()
+
+        self._clear_address_objects()
+        self._tune_session_for_bulk_load()
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        rows = self._read_address_objects(fname, step, processes, chunk_size)
+
+        # Соответствие GUID'ов адресных объектов их ID
+        guid_ids = {}
+        for i, row in enumerate(rows):
+            guid_ids.setdefault(row[0], i + 1)
+
+        cnt_all = len(rows)
+        print('Total: %i' % cnt_all)
+
+        # Порции строк ADDROBJ: (ID, PARENTID, SOCRCODE) и записи
+        # для вычисления отображаемых имён
+        def batches():
+            for start in range(0, cnt_all, step):
+                ids = []
+                names_rows = []
+                for i in range(start, min(start + step, cnt_all)):
+                    ao_id = i + 1
+                    socrcode, names_row = _good_name_row(ao_id, rows[i], socr, socr_codes)
+                    if names_row is not None:
+                        names_rows.append(names_row)
+
+                    parentguid = rows[i][6]
+                    ids.append((ao_id, guid_ids.get(parentguid, 0), socrcode))
+                yield ids, names_rows
+
+        cur = self.dbconn.cursor()
+        sql = """INSERT INTO addrobj%(version_suffix)s (id, parentid, socrcode,
+                displayname, aoguid, formalname, offname,
+                postalcode, shortname,
+                aolevel, parentguid, regioncode)
+            VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)""" % {
+                'version_suffix': self.version_suffix
+            }
+
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        cnt = 0
+        try:
+            # Отображаемые имена вычисляются в пуле, пока в БД
+            # записываются предыдущие порции
+            pending = deque()
+            for ids, names_rows in batches():
+                if pool is not None:
+                    pending.append((ids, pool.apply_async(_make_good_names, (names_rows,))))
+                else:
+                    pending.append((ids, _make_good_names(names_rows)))
+
+                while len(pending) > 0 and (pool is None or len(pending) >= processes * 2):
+                    cnt += self._insert_final_address_objects(cur, sql, rows, pending.popleft())
+                    self._progress('Loading data into ADDROBJ.', cnt, cnt_all)
+            while len(pending) > 0:
+                cnt += self._insert_final_address_objects(cur, sql, rows, pending.popleft())
+                self._progress('Loading data into ADDROBJ.', cnt, cnt_all)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        self.dbconn.commit()
+        cur.close()
+
+    def _insert_final_address_objects(self, cur, sql, rows, batch):
+        """Вставляет порцию готовых строк в таблицу ADDROBJ и возвращает
+        их кол-во."""
+        ids, names = batch
+        if not isinstance(names, list):
+            names = names.get()
+        names = dict(names)
+
+        values = []
+        for ao_id, parent_id, socrcode in ids:
+            values.append((ao_id, parent_id, socrcode, names.get(ao_id, '')) + rows[ao_id - 1])
+        cur.executemany(sql, values)
+        self.dbconn.commit()
+        return len(values)
+
+    def load_socr(self, fname, step=10000):
+        """Загружает сокращения из файла в таблицу SOCRBASE.
+
+        Поля CODE, NAME и DISPLAYNAME вычисляются при загрузке.
+        Загруженные сокращения сохраняются в self.socr и self.socr_codes
+        (см. _get_socr).
+        """
         self._clear_socr()
+        self._tune_session_for_bulk_load()
 
         cur = self.dbconn.cursor()
 
+        sql = """INSERT INTO socrbase%(version_suffix)s (level, scname, socrname, kod_t_st,
+                code, name, displayname)
+            VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s)""" % {
+                'version_suffix': self.version_suffix
+            }
+        rows = []
         cnt = 0
+        socr = {}
+        socr_codes = {}
 
-        for event, element in etree.iterparse(fname, events=('end',)):
+        for event, element in _iterparse(fname, events=('end',)):
             if element.get('SCNAME') is not None:
-                sql = """INSERT INTO socrbase%(version_suffix)s (level, scname, socrname, kod_t_st)
-                    VALUES (%(LEVEL)s, '%(SCNAME)s', '%(SOCRNAME)s', '%(KOD_T_ST)s')""" % {
-                        'version_suffix': self.version_suffix,
-                        'LEVEL': element.get('LEVEL'),
-                        'SCNAME': element.get('SCNAME'),
-                        'SOCRNAME': element.get('SOCRNAME'),
-                        'KOD_T_ST': element.get('KOD_T_ST'),
-                }
-                cur.execute(sql)
+                row = _socr_row(element)
+                rows.append(row)
+
+                level, scname, socrname, kod_t_st, code, name, displayname = row
+                socr.setdefault(code, {
+                    'socrname': socrname,
+                    's_code': code,
+                    'scname': scname,
+                    's_displayname': displayname,
+                })
+                if level is not None:
+                    socr_codes.setdefault((int(level), _socr_key(scname)), code)
 
             while element.getprevious() is not None:
                 del element.getparent()[0]
@@ -185,19 +853,36 @@ class AddressOKInitializer:
             element.clear()
 
             cnt += 1
-            if cnt % 1000 == 0:
+            if cnt % step == 0:
+                cur.executemany(sql, rows)
+                rows = []
                 self.dbconn.commit()
-                print("Loading data into SOCRBASE.", cnt)
+                self._progress("Loading data into SOCRBASE.", cnt)
 
-        if cnt % 1000 != 0:
-            print("Loading data into SOCRBASE.", cnt)
+        if len(rows) > 0:
+            cur.executemany(sql, rows)
+        if cnt % step != 0:
+            self._progress("Loading data into SOCRBASE.", cnt)
 
         self.dbconn.commit()
         cur.close()
 
+        self.socr = socr
+        self.socr_codes = socr_codes
+
+    def _get_socr(self):
+        """Возвращает сокращения по целочисленным кодам и коды сокращений
+        по уровням и сокращениям (см. _load_socr_codes
+        и _load_socr_level_codes). Если сокращения не загружались
+        методом load_socr, то они читаются из таблицы SOCRBASE."""
+        if self.socr is None:
+            self.socr = self._load_socr_codes()
+            self.socr_codes = self._load_socr_level_codes()
+        return self.socr, self.socr_codes
+
     def fill_zip_codes(self):
         """Заполняет таблицу ZIPCODES."""
-        cur = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        cur = self.dbconn.cursor(storage.DictCursor)
         cur2 = self.dbconn.cursor()
 
         cur.execute('TRUNCATE TABLE zipcodes'+self.version_suffix);
@@ -220,320 +905,128 @@ class AddressOKInitializer:
 
             cnt += 1
             if cnt % 1000 == 0:
-                print("Filling ZIPCODES table.", cnt)
+                self._progress("Filling ZIPCODES table.", cnt)
                 self.dbconn.commit()
 
         if cnt % 1000 != 0:
-            print("Filling ZIPCODES table.", cnt)
+            self._progress("Filling ZIPCODES table.", cnt)
 
         cur2.close()
         cur.close()
         self.dbconn.commit()
 
-    def _get_parentguids(self, aoguid):
-        """Возвращает список GUID'ов для адресного объекта."""
-        if aoguid == 'None':
-            return []
-        ret = []
-
-        cur = self.dbconn.cursor(pymysql.cursors.DictCursor)
-        sql = """SELECT parentguid FROM addrobj%(version_suffix)s
-            WHERE aoguid = '%(aoguid)s'""" % {
-                'version_suffix': self.version_suffix,
-                'aoguid': aoguid
-            }
-        cur.execute(sql)
-        row = cur.fetchone()
-        cur.close()
-
-        if row['parentguid'] is not None:
-            ret.append(row['parentguid'])
-            ret.extend(self._get_parentguids(row['parentguid']))
-
-        return ret
-
-    def _fill_zip_links(self, zipcode):
-        """Заполняет связи для почтового индекса."""
-
-        cur = self.dbconn.cursor(pymysql.cursors.DictCursor)
-
-        # Список GUID'ов адресных объектов с данным почтовым индексом
-        guids = []
-
-        sql = """SELECT
-            ao.aolevel,
-            ao.aoguid,
-            ao.parentguid
-        FROM addrobj%(version_suffix)s ao
-        WHERE
-            postalcode = '%(zipcode)s'
-            """ % {
-                'version_suffix': self.version_suffix,
-                'zipcode': zipcode
-            }
-        cur.execute(sql)
-        for row in cur:
-            guids.append(row['aoguid'])
-            # Получаем GUID'ы родительских адресных объектов
-            guids.extend(self._get_parentguids(row['aoguid']))
-
-        # Убираем дублирующиеся элементы списка
-        guids = list(set(guids))
-
-        sql = """INSERT INTO ziplinks%(version_suffix)s (zipid, aoid)
-            SELECT
-                (SELECT id FROM zipcodes%(version_suffix)s WHERE zip = '%(zipcode)s' LIMIT 1),
-                ao.id
-            FROM addrobj%(version_suffix)s ao
-            WHERE
-                ao.aoguid in (%(guids)s)""" %\
-                    {
-                        'version_suffix': self.version_suffix,
-                        'zipcode': zipcode,
-                        'guids': ', '.join([("'%s'" % guid) for guid in guids])
-                    }
-        cur.execute(sql)
-        cur.close()
-
-    def fill_zip_links(self):
-        """Заполняем соответствие почтовых индексов адресным объектам."""
-        cur = self.dbconn.cursor(pymysql.cursors.DictCursor)
-
-        cur.execute('TRUNCATE TABLE ziplinks'+self.version_suffix);
-        self.dbconn.commit()
-
-        # Получаем кол-во почтовых индексов (для счётчика)
-        sql = """SELECT count(*) cnt FROM zipcodes%(version_suffix)s""" % {
-            'version_suffix': self.version_suffix
-        }
-        cur.execute(sql)
-        cnt_all = cur.fetchone()['cnt']
-        cnt = 0
-
-        sql = """SELECT * FROM zipcodes%(version_suffix)s""" % {
-            'version_suffix': self.version_suffix
-        }
-        cur.execute(sql)
-        for row in cur:
-            self._fill_zip_links(row['zip'])
-
-            cnt += 1
-            if cnt % 100 == 0:
-                print("Filling ZIPLINKS table. %s / %s" % (cnt, cnt_all))
-                self.dbconn.commit()
-
-        if cnt % 100 != 0:
-            print("Filling ZIPLINKS table. %s / %s" % (cnt, cnt_all))
-
-        self.dbconn.commit()
-
-        cur.close()
-
-    def fill_socr_codes(self):
-        """Заполняет целочисленные коды в таблице SOCRBASE."""
-
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
-        cur2 = self.dbconn.cursor(pymysql.cursors.DictCursor)
+    def fill_zip_links(self, step=1000, regioncode=None):
+        """Заполняем соответствие почтовых индексов адресным объектам.
 
-        sql = """SELECT * FROM socrbase%(version_suffix)s""" % {
-            'version_suffix': self.version_suffix
-        }
-        cur1.execute(sql)
-        for row in cur1:
-            if row['kod_t_st'] is not None:
-                sql = """UPDATE socrbase%(version_suffix)s
-                    SET
-                        code = %(code)i
-                    WHERE
-                        id = %(id)i""" % \
-                    {
-                        'version_suffix': self.version_suffix,
-                        'id': row['id'],
-                        'code': int(row['kod_t_st'])
-                    }
-                cur2.execute(sql)
+        Почтовый индекс связывается с адресными объектами, у которых
+        он указан, и со всеми их предками. Предки находятся за один
+        проход по хранящемуся в памяти соответствию ID объектов ID
+        их родителей (поле PARENTID должно быть уже заполнено).
 
-        self.dbconn.commit()
-        
-        cur2.close()
-        cur1.close()
+        Если задан regioncode, то обрабатываются только объекты региона,
+        а таблица ZIPLINKS не очищается (см. fill_regions).
+        """
+        cur1 = self.dbconn.cursor(storage.SSCursor)
+        cur2 = self.dbconn.cursor()
 
-    def fill_socr_names(self):
-        """Заполняет поле NAME в таблице SOCRBASE (заполняет его
-        в нижнем регистре)."""
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
-        cur2 = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        if regioncode is None:
+            cur2.execute('TRUNCATE TABLE ziplinks'+self.version_suffix);
+            self.dbconn.commit()
 
-        sql = """SELECT * FROM socrbase%(version_suffix)s""" % {
+        # Соответствие почтовых индексов их ID
+        zip_ids = OrderedDict()
+        sql = """SELECT id, zip FROM zipcodes%(version_suffix)s ORDER BY id""" % {
             'version_suffix': self.version_suffix
         }
         cur1.execute(sql)
-        for row in cur1:
-            sql = """UPDATE socrbase%(version_suffix)s
-                SET
-                    name = '%(name)s'
-                WHERE
-                    id = %(id)i""" % \
-                {
-                    'version_suffix': self.version_suffix,
-                    'id': row['id'],
-                    'name': row['socrname'].lower()
-                }
-            cur2.execute(sql)
-
-        self.dbconn.commit()
-
-        cur2.close()
+        for zip_id, zip_code in cur1:
+            zip_ids.setdefault(zip_code, zip_id)
         cur1.close()
 
-    def fill_addrobj_socr(self, step=1000):
-        """Заполняет поле SOCRCODE в таблице ADDROBJ."""
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
-        cur2 = self.dbconn.cursor(pymysql.cursors.DictCursor)
-
-        where = "ao.aolevel = 1 and livestatus = 1"
-        where = "ao.aolevel not in (90, 91)"
-
-        # Счётчик
-        print('Counting...')
-        sql = """SELECT
-                count(*) cnt
-            FROM addrobj%(version_suffix)s ao
-            INNER JOIN socrbase%(version_suffix)s s ON s.level = ao.aolevel and s.scname = ao.shortname
-            WHERE %(where)s""" % {
+        # Соответствие ID адресных объектов ID их родителей
+        parents = {}
+        # Адресные объекты с данным почтовым индексом
+        zip_objects = {}
+        cur1 = self.dbconn.cursor(storage.SSCursor)
+        sql = """SELECT id, parentid, postalcode FROM addrobj%(version_suffix)s
+            WHERE %(region)s""" % {
                 'version_suffix': self.version_suffix,
-                'where': where
+                'region': self._region_condition(regioncode),
             }
         cur1.execute(sql)
-        cnt_all = cur1.fetchone()['cnt']
+        for ao_id, parent_id, postalcode in cur1:
+            parents[ao_id] = parent_id or 0
+            if postalcode in zip_ids:
+                zip_objects.setdefault(postalcode, []).append(ao_id)
+        cur1.close()
+
+        cnt_all = len(zip_ids)
         cnt = 0
-        print('Total %i' % cnt_all)
 
-        # Обработка
-        sql = """SELECT
-                ao.id aoid,
-                s.code socrcode
-            FROM addrobj%(version_suffix)s ao
-            INNER JOIN socrbase%(version_suffix)s s ON s.level = ao.aolevel and s.scname = ao.shortname
-            WHERE %(where)s""" % {
-                'version_suffix': self.version_suffix,
-                'where': where
-            }
-        cur1.execute(sql)
-        for row in cur1:
-            sql = """UPDATE addrobj%(version_suffix)s SET socrcode = %(socrcode)i WHERE id = %(aoid)i""" % {
-                'version_suffix': self.version_suffix,
-                'aoid': row['aoid'],
-                'socrcode': row['socrcode'],
+        sql = """INSERT INTO ziplinks%(version_suffix)s (zipid, aoid)
+            VALUES (%%s, %%s)""" % {
+                'version_suffix': self.version_suffix
             }
-            cur2.execute(sql)
+        rows = []
+        for zip_code, zip_id in zip_ids.items():
+            # Адресные объекты с данным почтовым индексом и их предки
+            rows.extend(_zip_links(zip_id, zip_objects.get(zip_code, []), parents))
 
             cnt += 1
             if cnt % step == 0:
-                print('Filling SOCRCODE field in ADDROBJ table. %s / %s' % (cnt, cnt_all))
+                cur2.executemany(sql, rows)
+                rows = []
+                self._progress("Filling ZIPLINKS table.", cnt, cnt_all)
                 self.dbconn.commit()
 
+        if len(rows) > 0:
+            cur2.executemany(sql, rows)
         if cnt % step != 0:
-            print('Filling SOCRCODE field in ADDROBJ table. %s / %s' % (cnt, cnt_all))
-            self.dbconn.commit()
+            self._progress("Filling ZIPLINKS table.", cnt, cnt_all)
+
+        self.dbconn.commit()
 
         cur2.close()
-        cur1.close()
 
-    def fill_socr_diplaynames(self):
-        """Заполняет поле DISPLAYNAME в таблице SOCRBASE."""
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
-        cur2 = self.dbconn.cursor(pymysql.cursors.DictCursor)
-
-        # Свойство 'type' обозначает тип сокращения:
-        # 'dot' -- пишется с точкой в конце ("г.", "ул." и т.д.)
-        # 'upper' -- пишется большими буквами ("СНТ", "ДНП" и т.д.)
-        dn = {
-            102: {'name': 'АО', 'scname': 'Аобл'},
-            103: {'type': 'dot', 'scname': 'г'},
-            105: {'type': 'dot', 'scname': 'обл'},
-            106: {'name': 'респ.', 'scname': 'Респ'},
-            306: {'type': 'dot', 'scname': 'п'},
-            303: {'type': 'dot', 'scname': 'тер'},
-            302: {'type': 'dot', 'scname': 'у'},
-            401: {'type': 'dot', 'scname': 'г'},
-            405: {'type': 'upper', 'scname': 'дп'},
-            404: {'type': 'upper', 'scname': 'кп'},
-            417: {'type': 'dot', 'scname': 'п'},
-            412: {'type': 'dot', 'scname': 'тер'},
-            502: {'type': 'dot', 'scname': 'тер'},
-            604: {'type': 'dot', 'scname': 'высел'},
-            605: {'type': 'dot', 'scname': 'г'},
-            606: {'type': 'dot', 'scname': 'д'},
-            617: {'type': 'dot', 'scname': 'м'},
-            621: {'type': 'dot', 'scname': 'п'},
-            630: {'type': 'dot', 'scname': 'с'},
-            631: {'type': 'dot', 'scname': 'сл'},
-            641: {'type': 'upper', 'scname': 'снт'},
-            632: {'type': 'dot', 'scname': 'ст'},
-            637: {'type': 'dot', 'scname': 'тер'},
-            634: {'type': 'dot', 'scname': 'у'},
-            635: {'type': 'dot', 'scname': 'х'},
-            #734: {'type': 'dot', 'scname': 'высел'},
-            763: {'type': 'upper', 'scname': 'гск'},
-            736: {'type': 'dot', 'scname': 'д'},
-            787: {'type': 'upper', 'scname': 'днп'},
-            704: {'type': 'dot', 'scname': 'дор'},
-            744: {'type': 'dot', 'scname': 'м'},
-            711: {'type': 'dot', 'scname': 'наб'},
-            714: {'type': 'dot', 'scname': 'пер'},
-            9114: {'type': 'dot', 'scname': 'пер'},
-            716: {'type': 'dot', 'scname': 'пл'},
-            747: {'type': 'dot', 'scname': 'платф'},
-            755: {'type': 'dot', 'scname': 'с'},
-            756: {'type': 'dot', 'scname': 'сл'},
-            757: {'type': 'dot', 'scname': 'ст'},
-            725: {'type': 'dot', 'scname': 'стр'},
-            726: {'type': 'dot', 'scname': 'тер'},
-            728: {'type': 'dot', 'scname': 'туп'},
-            729: {'type': 'dot', 'scname': 'ул'},
-            9129: {'type': 'dot', 'scname': 'ул'},
-            758: {'type': 'dot', 'scname': 'х'},
-            731: {'type': 'dot', 'scname': 'ш'},
-        }
+    def fill_addrobj_socr(self, step=10000, regioncode=None):
+        """Заполняет поле SOCRCODE в таблице ADDROBJ (коды сокращений
+        берутся из памяти, см. _get_socr). Если задан regioncode, то
+        заполняется только для объектов региона."""
+        socr, socr_codes = self._get_socr()
 
-        sql = """SELECT * FROM socrbase%(version_suffix)s""" % {
-            'version_suffix': self.version_suffix
-        }
+        cur1 = self.dbconn.cursor(storage.SSCursor)
+        cur2 = self.dbconn.cursor()
+
+        # Пары (ID адресного объекта, код сокращения)
+        rows = []
+        sql = """SELECT id, aolevel, shortname FROM addrobj%(version_suffix)s
+            WHERE %(region)s""" % {
+                'version_suffix': self.version_suffix,
+                'region': self._region_condition(regioncode),
+            }
         cur1.execute(sql)
-        for row in cur1:
-            row['displayname'] = row['scname']
-            if row['code'] in dn.keys():
-                if row['scname'] != dn[row['code']]['scname']:
-                    print(row['code'])
-                    print(row['scname'].encode('utf-8'))
-                    print(dn[row['code']]['scname'].encode('utf-8'))
-                assert row['scname'] == dn[row['code']]['scname']
-
-                if 'type' in dn[row['code']].keys():
-                    socrtype = dn[row['code']]['type']
-                    if socrtype == 'dot':
-                        row['displayname'] = row['scname']+'.'
-                    elif socrtype == 'upper':
-                        row['displayname'] = row['scname'].upper()
-                if 'name' in dn[row['code']].keys():
-                    row['displayname'] = dn[row['code']]['name']
-
-            row['version_suffix'] = self.version_suffix
-            sql = """UPDATE socrbase%(version_suffix)s SET displayname = '%(displayname)s'
-                WHERE id = %(id)i""" % row
-            cur2.execute(sql)
+        for ao_id, aolevel, shortname in cur1:
+            if aolevel in (90, 91) or aolevel is None or shortname is None:
+                continue
+            socrcode = socr_codes.get((aolevel, _socr_key(shortname)))
+            if socrcode is not None:
+                rows.append((ao_id, socrcode))
+        cur1.close()
 
-        self.dbconn.commit()
+        cnt_all = len(rows)
+        print('Total %i' % cnt_all)
 
-        cur2.close()
-        cur1.close()
+        for start in range(0, cnt_all, step):
+            self._update_column(cur2, 'addrobj', 'socrcode', rows[start:start + step])
+            self.dbconn.commit()
+            self._progress('Filling SOCRCODE field in ADDROBJ table.', min(start + step, cnt_all), cnt_all)
 
+        cur2.close()
 
     def fill_good_names_old(self):
         """Заполняет поле DISPLAYNAME в таблице ADDROBJ."""
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
-        cur2 = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        cur1 = self.dbconn.cursor(storage.DictCursor)
+        cur2 = self.dbconn.cursor(storage.DictCursor)
 
         names_maker = gnm.GoodNamesMaker()
 
@@ -576,112 +1069,142 @@ class AddressOKInitializer:
 
             cnt += 1
             if cnt % 100 == 0:
-                print('Filling DISPLAYNAME field in ADDROBJ table. %s / %s' % (cnt, cnt_all))
+                self._progress('Filling DISPLAYNAME field in ADDROBJ table.', cnt, cnt_all)
                 self.dbconn.commit()
 
         if cnt % 100 != 0:
-            print('Filling DISPLAYNAME field in ADDROBJ table. %s / %s' % (cnt, cnt_all))
+            self._progress('Filling DISPLAYNAME field in ADDROBJ table.', cnt, cnt_all)
         self.dbconn.commit()
 
         cur2.close()
         cur1.close()
 
 
-    def fill_good_names(self):
-        """Заполняет поле DISPLAYNAME в таблице ADDROBJ."""
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
-        cur2 = self.dbconn.cursor(pymysql.cursors.DictCursor)
-
+    def _load_socr_level_codes(self):
+        """Возвращает соответствие (уровень, ключ сокращения) целочисленным
+        кодам сокращений из таблицы SOCRBASE (см. _socr_key)."""
+        res = {}
+        cur = self.dbconn.cursor()
+        sql = """SELECT level, scname, code
+            FROM socrbase%(version_suffix)s
+            ORDER BY id""" % {
+                'version_suffix': self.version_suffix
+            }
+        cur.execute(sql)
+        for level, scname, code in cur:
+            if level is not None and scname is not None:
+                res.setdefault((int(level), _socr_key(scname)), code)
+        cur.close()
+        return res
 
-        # ToDo: remove this.
-        if False:
-            sql = """SELECT * FROM socrbase%(version_suffix)s""" % {
+    def _load_socr_codes(self):
+        """Возвращает словарь с сокращениями из таблицы SOCRBASE
+        (по целочисленным кодам)."""
+        res = {}
+        cur = self.dbconn.cursor(storage.DictCursor)
+        sql = """SELECT
+                s.socrname,
+                s.code s_code,
+                s.scname,
+                s.displayname s_displayname
+            FROM socrbase%(version_suffix)s s
+            ORDER BY s.id""" % {
                 'version_suffix': self.version_suffix
             }
-            cur1.execute(sql)
-            for row in cur1:
-                print(row['code'])
-                print(row['level'])
-            return
+        cur.execute(sql)
+        for row in cur:
+            res.setdefault(row['s_code'], row)
+        cur.close()
+        return res
 
+    def _select_good_name_rows(self, cur, socr, last_id, limit, regioncode=None):
+        """Возвращает очередную порцию адресных объектов (с ID больше
+        last_id) для заполнения поля DISPLAYNAME."""
+        sql = """SELECT
+                id,
+                formalname,
+                socrcode,
+                aolevel,
+                regioncode
+            FROM addrobj%(version_suffix)s ao
+            WHERE
+                ao.socrcode != 0
+                and ao.id > %(last_id)s
+                and %(region)s
+            ORDER BY ao.id
+            LIMIT %(limit)s""" % {
+                'version_suffix': self.version_suffix,
+                'region': self._region_condition(regioncode),
+                'last_id': last_id,
+                'limit': limit,
+            }
+        cur.execute(sql)
+        rows = cur.fetchall()
+        for row in rows:
+            row.update(socr[row['socrcode']])
+        return rows
+
+    def fill_good_names(self, step=10000, processes=None, regioncode=None):
+        """Заполняет поле DISPLAYNAME в таблице ADDROBJ.
+
+        Адресные объекты выбираются порциями по step записей,
+        отображаемые имена вычисляются в пуле из processes процессов
+        (по умолчанию -- по кол-ву процессоров) и записываются в БД
+        порциями. Если задан regioncode, то обрабатываются только
+        объекты региона.
+        """
+        cur1 = self.dbconn.cursor(storage.DictCursor)
+        cur2 = self.dbconn.cursor()
 
-        names_maker = gnm.GoodNamesMaker()
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        socr, socr_codes = self._get_socr()
 
         sql = """SELECT count(*) cnt FROM addrobj%(version_suffix)s ao
-            INNER JOIN socrbase%(version_suffix)s s ON s.code = ao.socrcode""" % {
-                'version_suffix': self.version_suffix
+            WHERE ao.socrcode != 0 and %(region)s""" % {
+                'version_suffix': self.version_suffix,
+                'region': self._region_condition(regioncode),
             }
         print('Counting...')
         cur1.execute(sql)
         cnt_all = cur1.fetchone()['cnt']
         print('Total: %s' % cnt_all)
 
-        # ToDo: remove commented-out lines
-        sql = """SELECT
-                ao.id,
-                # ao.formalname,
-                # ao.offname,
-                # ao.socrname,
-                ao.socrcode
-                # ao.aolevel,
-                # ao.regioncode
-            FROM addrobj%(version_suffix)s ao
-            -- INNER JOIN socrbase%(version_suffix)s s ON s.code = ao.socrcode
-            WHERE ao.socrcode != 0
-            -- LIMIT 20
-            """ % {
-                'version_suffix': self.version_suffix
-            }
-        print('Selecting...')
-        cur1.execute(sql)
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        # Порции, отправленные в пул и ещё не записанные в БД
+        pending = deque()
+        last_id = 0
         cnt = 0
-        for row in cur1:
-            sql = """SELECT
-                    id,
-                    formalname,
-                    socrcode,
-                    aolevel,
-                    regioncode
-                FROM addrobj%(version_suffix)s ao
-                WHERE ao.id = %(id)s""" % {
-                    'id': row['id'],
-                    'version_suffix': self.version_suffix,
-                }
-            cur2.execute(sql)
-            row2 = cur2.fetchone()
-
-            sql = """SELECT
-                    s.socrname,
-                    s.code s_code,
-                    s.scname,
-                    s.displayname s_displayname
-                FROM socrbase%(version_suffix)s s
-                WHERE s.code = %(socrcode)s""" % {
-                    'socrcode': row2['socrcode'],
-                    'version_suffix': self.version_suffix,
-                }
-            cur2.execute(sql)
-            row_socr = cur2.fetchone()
-
-            row2.update(row_socr)
-
-            good_name = names_maker.make_good_name(row2)
-
-            sql = """UPDATE addrobj%(version_suffix)s SET displayname = '%(good_name)s'
-                WHERE id = %(ao_id)s""" % {
-                    'version_suffix': self.version_suffix,
-                    'good_name': good_name,
-                    'ao_id': row2['id'],
-                }
-            cur2.execute(sql)
+        try:
+            while True:
+                rows = self._select_good_name_rows(cur1, socr, last_id, step, regioncode)
+                if len(rows) > 0:
+                    last_id = rows[-1]['id']
+                    if pool is not None:
+                        pending.append(pool.apply_async(_make_good_names, (rows,)))
+                    else:
+                        pending.append(_make_good_names(rows))
+
+                # Записываем готовые порции, оставляя в пуле
+                # не больше двух порций на процесс
+                while len(pending) > 0 and (len(rows) == 0 or len(pending) >= processes * 2):
+                    names = pending.popleft()
+                    if pool is not None:
+                        names = names.get()
+                    self._update_column(cur2, 'addrobj', 'displayname', names)
+
+                    cnt += len(names)
+                    self._progress('Filling DISPLAYNAME field in ADDROBJ table.', cnt, cnt_all)
+                    self.dbconn.commit()
+
+                if len(rows) == 0:
+                    break
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
-            cnt += 1
-            if cnt % 100 == 0:
-                print('Filling DISPLAYNAME field in ADDROBJ table. %s / %s' % (cnt, cnt_all))
-                self.dbconn.commit()
-
-        if cnt % 100 != 0:
-            print('Filling DISPLAYNAME field in ADDROBJ table. %s / %s' % (cnt, cnt_all))
         self.dbconn.commit()
 
         cur2.close()
@@ -689,8 +1212,8 @@ class AddressOKInitializer:
 
     # ToDo: remove this.
     def fill_parent_ids_old(self):
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
-        cur2 = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        cur1 = self.dbconn.cursor(storage.DictCursor)
+        cur2 = self.dbconn.cursor(storage.DictCursor)
 
         # Counting rows
         sql = """SELECT count(*) cnt FROM addrobj%(version_suffix)s""" % {
@@ -714,7 +1237,7 @@ class AddressOKInitializer:
                 'version_suffix': self.version_suffix
             }
         cur1.close()
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
+        cur1 = self.dbconn.cursor(storage.DictCursor)
         cur1.execute(sql)
         for row in cur1:
             print(row)
@@ -739,56 +1262,740 @@ class AddressOKInitializer:
         cur1.close()
 
 
-    def fill_parent_ids(self):
-        """Заполняет поле PARENTID в таблице ADDROBJ."""
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
-        cur2 = self.dbconn.cursor(pymysql.cursors.DictCursor)
+    def _update_column(self, cur, table, column, rows):
+        """Записывает значения поля в таблицу одним запросом.
 
-        # Счётчик
-        sql = """SELECT count(*) cnt FROM addrobj%(version_suffix)s""" % {
+        Запрос, отменённый из-за взаимной блокировки или истечения
+        времени ожидания блокировки (при заполнении регионов в нескольких
+        процессах, см. fill_regions), повторяется после отката
+        транзакции, поэтому до вызова транзакция должна быть
+        зафиксирована.
+
+        Аргументы:
+            table (str): имя таблицы без суффикса версии.
+            rows (list): пары (ID записи, новое значение).
+        """
+        sql = """INSERT INTO %(table)s%(version_suffix)s (id, %(column)s)
+            VALUES (%%s, %%s)
+            ON DUPLICATE KEY UPDATE %(column)s = VALUES(%(column)s)""" % {
+                'version_suffix': self.version_suffix,
+                'table': table,
+                'column': column,
+            }
+        for attempt in range(LOCK_RETRIES + 1):
+            try:
+                cur.executemany(sql, rows)
+                return
+            except storage.OperationalError as err:
+                if err.args[0] not in (storage.ER_LOCK_DEADLOCK, storage.ER_LOCK_WAIT_TIMEOUT) \
+                        or attempt == LOCK_RETRIES:
+                    raise
+                print('Lock error %s while updating %s. Retrying...' % (err.args[0], column.upper()))
+                self.dbconn.rollback()
+                time.sleep(attempt + 1)
+
+    def fill_parent_ids(self, step=10000, regioncode=None):
+        """Заполняет поле PARENTID в таблице ADDROBJ. Если задан
+        regioncode, то заполняется только для объектов региона
+        (родители ищутся среди объектов того же региона)."""
+        cur1 = self.dbconn.cursor(storage.SSCursor)
+        cur2 = self.dbconn.cursor()
+
+        # Соответствие GUID'ов адресных объектов их ID
+        guid_ids = {}
+        # Пары (ID адресного объекта, GUID родительского объекта)
+        parent_guids = []
+
+        sql = """SELECT
+                ao.id,
+                ao.aoguid,
+                ao.parentguid
+            FROM addrobj%(version_suffix)s ao
+            WHERE %(region)s
+            ORDER BY ao.id""" % {
+                'version_suffix': self.version_suffix,
+                'region': self._region_condition(regioncode),
+            }
+        cur1.execute(sql)
+        for ao_id, aoguid, parentguid in cur1:
+            guid_ids.setdefault(aoguid, ao_id)
+            parent_guids.append((ao_id, parentguid))
+        cur1.close()
+
+        cnt_all = len(parent_guids)
+        print('Total: %i' % cnt_all)
+
+        cnt = 0
+        rows = []
+        for ao_id, parentguid in parent_guids:
+            rows.append((ao_id, guid_ids.get(parentguid, 0)))
+
+            cnt += 1
+            if cnt % step == 0:
+                self._update_column(cur2, 'addrobj', 'parentid', rows)
+                rows = []
+                self._progress('Filling PARENTID field in ADDROBJ table.', cnt, cnt_all)
+                self.dbconn.commit()
+
+        if len(rows) > 0:
+            self._update_column(cur2, 'addrobj', 'parentid', rows)
+        if cnt % step != 0:
+            self._progress('Filling PARENTID field in ADDROBJ table.', cnt, cnt_all)
+        self.dbconn.commit()
+
+        cur2.close()
+
+    def fill_regions(self, processes=None):
+        """Заполняет поля PARENTID, SOCRCODE и DISPLAYNAME и таблицы
+        ADDRPATHS и ZIPLINKS по регионам в пуле из processes процессов
+        (у каждого процесса своё соединение с БД, см. self.connect).
+
+        Иерархия адресных объектов не пересекает границы регионов,
+        поэтому регионы обрабатываются независимо. Таблица ZIPCODES
+        должна быть уже заполнена. После обработки регионов ссылки
+        на родителей из других регионов (если они всё же есть)
+        исправляются в одном процессе (см. _merge_regions).
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        # Объекты региона выбираются по индексу
+        self._create_index('addrobj', 'regioncode')
+
+        cur = self.dbconn.cursor()
+        cur.execute('TRUNCATE TABLE addrpaths'+self.version_suffix)
+        cur.execute('TRUNCATE TABLE ziplinks'+self.version_suffix)
+        self.dbconn.commit()
+
+        sql = """SELECT DISTINCT regioncode FROM addrobj%(version_suffix)s""" % {
             'version_suffix': self.version_suffix
         }
+        cur.execute(sql)
+        regions = sorted(set([row[0] or '' for row in cur.fetchall()]))
+        cur.close()
+        self.dbconn.commit()
+
+        print('Filling regions. Regions: %s, processes: %s' % (len(regions), processes))
+        pool = multiprocessing.Pool(processes)
+        cnt = 0
+        try:
+            args = [(self.connect, self.version, regioncode) for regioncode in regions]
+            for regioncode, statements in pool.imap_unordered(_fill_region, args):
+                self.stage_statements += statements
+                cnt += 1
+                self._progress('Filling regions.', cnt, len(regions))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self._merge_regions()
+
+    def _merge_regions(self):
+        """Исправляет PARENTID у объектов, родители которых находятся
+        в других регионах, и в этом случае заново заполняет таблицы
+        ADDRPATHS и ZIPLINKS целиком."""
+        cur1 = self.dbconn.cursor(storage.SSCursor)
+        cur2 = self.dbconn.cursor()
+
+        # Соответствие GUID'ов адресных объектов их ID
+        guid_ids = {}
+        # Объекты без родителя в своём регионе: (ID, GUID родителя)
+        orphans = []
+        sql = """SELECT id, aoguid, parentguid, parentid
+            FROM addrobj%(version_suffix)s
+            ORDER BY id""" % {
+                'version_suffix': self.version_suffix
+            }
         cur1.execute(sql)
-        cnt_all = cur1.fetchone()['cnt']
+        for ao_id, aoguid, parentguid, parent_id in cur1:
+            guid_ids.setdefault(aoguid, ao_id)
+            if not parent_id and parentguid is not None:
+                orphans.append((ao_id, parentguid))
+        cur1.close()
+
+        rows = [(ao_id, guid_ids[parentguid]) for ao_id, parentguid in orphans
+            if parentguid in guid_ids]
+        print('Parents in other regions: %i' % len(rows))
+        if len(rows) > 0:
+            self._update_column(cur2, 'addrobj', 'parentid', rows)
+            self.dbconn.commit()
+            self.fill_addr_paths()
+            self.fill_zip_links()
+
+        cur2.close()
+
+    def fill_addr_paths(self, step=10000, regioncode=None):
+        """Заполняет таблицу ADDRPATHS (для каждого адресного объекта
+        сохраняет его самого и всех его предков). Если задан regioncode,
+        то заполняется только для объектов региона, а таблица
+        не очищается (см. fill_regions)."""
+        cur1 = self.dbconn.cursor(storage.SSCursor)
+        cur2 = self.dbconn.cursor()
+
+        if regioncode is None:
+            cur2.execute('TRUNCATE TABLE addrpaths'+self.version_suffix)
+            self.dbconn.commit()
+
+        # Соответствие ID адресных объектов ID их родителей
+        parents = {}
+        sql = """SELECT id, parentid FROM addrobj%(version_suffix)s
+            WHERE %(region)s""" % {
+                'version_suffix': self.version_suffix,
+                'region': self._region_condition(regioncode),
+            }
+        cur1.execute(sql)
+        for ao_id, parent_id in cur1:
+            parents[ao_id] = parent_id or 0
+        cur1.close()
+
+        cnt_all = len(parents)
         print('Total: %i' % cnt_all)
 
+        sql = """INSERT INTO addrpaths%(version_suffix)s (aoid, ancestorid, depth)
+            VALUES (%%s, %%s, %%s)""" % {
+                'version_suffix': self.version_suffix
+            }
+        rows = []
         cnt = 0
+        for ao_id in parents:
+            rows.extend(_addr_paths(ao_id, parents))
+
+            cnt += 1
+            if cnt % step == 0:
+                cur2.executemany(sql, rows)
+                rows = []
+                self._progress('Filling ADDRPATHS table.', cnt, cnt_all)
+                self.dbconn.commit()
+
+        if len(rows) > 0:
+            cur2.executemany(sql, rows)
+        if cnt % step != 0:
+            self._progress('Filling ADDRPATHS table.', cnt, cnt_all)
+        self.dbconn.commit()
+
+        cur2.close()
+
+    def write_zip_index(self, index_dir):
+        """Записывает файл индекса почтовых индексов для данной версии БД
+        (см. модуль zipindex) и возвращает его имя."""
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        fname = zipindex.index_file_name(index_dir, self.version)
 
+        cur = self.dbconn.cursor(storage.SSCursor)
         sql = """SELECT
-                ao.id ao_id,
-                ao.parentguid
-            FROM addrobj%(version_suffix)s ao
-            """ % {
+                zc.zip,
+                ao.aolevel,
+                ao.id,
+                ao.displayname
+            FROM zipcodes%(version_suffix)s zc
+            INNER JOIN ziplinks%(version_suffix)s zl ON zl.zipid = zc.id
+            INNER JOIN addrobj%(version_suffix)s ao ON zl.aoid = ao.id
+            WHERE
+                aolevel in (1,3,4,6,7)
+            ORDER BY zc.zip, ao.aolevel, ao.formalname""" % {
                 'version_suffix': self.version_suffix
             }
+        print('Writing zip index file %s' % fname)
+        cur.execute(sql)
+        cnt = zipindex.write_zip_index(fname, cur)
+        cur.close()
+        self._progress('Writing zip index file.', cnt)
+
+        return fname
+
+    def _create_build_state_table(self):
+        """Создаёт таблицу BUILD_STATE с завершёнными этапами сборки
+        версий БД."""
+        cur = self.dbconn.cursor()
+        cur.execute("""CREATE TABLE IF NOT EXISTS build_state (
+                version INTEGER NOT NULL,
+                stage VARCHAR(50) NOT NULL,
+                source VARCHAR(100) DEFAULT '',
+                finished_at DATETIME,
+
+                PRIMARY KEY(version, stage)
+            )""")
+        cur.close()
+
+    def get_finished_stages(self, source=''):
+        """Возвращает множество завершённых этапов сборки данной версии БД
+        из исходных данных source (например, даты версии ФИАС)."""
+        self._create_build_state_table()
+        cur = self.dbconn.cursor()
+        cur.execute("""SELECT stage FROM build_state
+            WHERE version = %s and source = %s""", (self.version, source))
+        res = set([row[0] for row in cur.fetchall()])
+        cur.close()
+        self.dbconn.commit()
+        return res
+
+    def reset_build_state(self):
+        """Удаляет сведения о завершённых этапах сборки данной версии БД."""
+        self._create_build_state_table()
+        cur = self.dbconn.cursor()
+        cur.execute("DELETE FROM build_state WHERE version = %s", (self.version,))
+        cur.close()
+        self.dbconn.commit()
+
+    def _get_statement_count(self):
+        """Возвращает кол-во запросов, выполненных в текущей сессии БД."""
+        cur = self.dbconn.cursor()
+        cur.execute("SHOW SESSION STATUS LIKE 'Questions'")
+        row = cur.fetchone()
+        cur.close()
+        return int(row[1])
+
+    def run_stage(self, name, func, *args, **kwargs):
+        """Выполняет этап сборки, если он ещё не завершён, и записывает
+        в таблицу BUILD_STATE его завершение.
+
+        Показатели этапа добавляются в self.metrics: время выполнения,
+        кол-во обработанных строк и строк в секунду, кол-во запросов
+        к БД (включая запросы процессов со своими соединениями, см.
+        fill_regions) и пиковый объём памяти (RSS в КБ) процесса сборки и его
+        дочерних процессов на момент завершения этапа.
+        """
+        if name in self.finished_stages:
+            print('Stage %s is already finished. Skipping.' % name)
+            self.metrics.append({'stage': name, 'skipped': True})
+            return
+        print('Stage %s...' % name)
+
+        self.stage = name
+        self.stage_rows = 0
+        self.stage_statements = 0
+        statements = self._get_statement_count()
+        t1 = time.time()
+
+        func(*args, **kwargs)
+
+        seconds = time.time() - t1
+        # Запрос SHOW STATUS тоже учитывается в счётчике
+        statements = self._get_statement_count() - statements - 1 + self.stage_statements
+        self.metrics.append({
+            'stage': name,
+            'skipped': False,
+            'seconds': round(seconds, 3),
+            'rows': self.stage_rows,
+            'rows_per_second': round(self.stage_rows / seconds, 1) if seconds > 0 else None,
+            'sql_statements': statements,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        })
+        print('Stage %s finished. %.1f s, rows: %s' % (name, seconds, self.stage_rows))
+
+        self.dbconn.commit()
+        cur = self.dbconn.cursor()
+        cur.execute("""INSERT INTO build_state (version, stage, source, finished_at)
+            VALUES (%s, %s, %s, NOW())
+            ON DUPLICATE KEY UPDATE source = VALUES(source), finished_at = VALUES(finished_at)""",
+            (self.version, name, self.source))
+        cur.close()
+        self.dbconn.commit()
+        self.finished_stages.add(name)
+        self.stage = None
+
+    def write_build_report(self, fname, seconds=None):
+        """Записывает показатели этапов сборки в JSON-файл."""
+        dirname = os.path.dirname(fname)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        report = {
+            'version': self.version,
+            'source': self.source,
+            'regions': sorted(self.regions) if self.regions is not None else None,
+            'seconds': round(seconds, 3) if seconds is not None else None,
+            'stages': self.metrics,
+        }
+        with open(fname, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    def build(self, addrobj_fname, socr_fname, source='', mode='multi_pass',
+            processes=None, defer_indexes=True, index_dir=None,
+            report_file=None, progress=None):
+        """Создаёт и заполняет таблицы данной версии БД.
+
+        Завершённые этапы сборки записываются в таблицу BUILD_STATE.
+        При повторном запуске сборки той же версии из тех же исходных
+        данных (source) сборка продолжается с первого незавершённого
+        этапа. Все этапы можно выполнять повторно: каждый из них
+        заново заполняет свои таблицы или поля.
+
+        Аргументы:
+            mode (str): 'multi_pass', 'single_pass'
+                (см. load_address_objects_single_pass) или 'regions'
+                (см. fill_regions).
+            index_dir (str): папка для файла индекса почтовых индексов
+                (None -- файл не создаётся).
+            report_file (str): JSON-файл с показателями этапов сборки
+                (см. run_stage), записывается и при ошибке сборки.
+            progress: функция, которой передаётся ход выполнения этапов
+                (см. self.progress).
+        """
+        self._run_build(source, report_file, progress, self._build,
+            addrobj_fname, socr_fname, mode, processes, defer_indexes, index_dir)
+
+    def _run_build(self, source, report_file, progress, build_func, *args):
+        """Выполняет этапы сборки (build_func), продолжая прерванную
+        сборку из тех же исходных данных, и записывает отчёт."""
+        self.progress = progress
+        self.metrics = []
+        t1 = time.time()
+        try:
+            self.source = source
+            self.finished_stages = self.get_finished_stages(source)
+            if len(self.finished_stages) == 0:
+                # Сведения о сборке из других исходных данных
+                self.reset_build_state()
+
+            build_func(*args)
+        finally:
+            if report_file is not None:
+                self.write_build_report(report_file, time.time() - t1)
+
+    def _build(self, addrobj_fname, socr_fname, mode, processes,
+            defer_indexes, index_dir):
+        self.run_stage('create_tables', self.create_tables, defer_indexes=defer_indexes)
+
+        if mode == 'single_pass':
+            # Строки ADDROBJ записываются один раз
+            self.run_stage('load_address_objects_single_pass',
+                self.load_address_objects_single_pass, addrobj_fname, socr_fname,
+                processes=processes)
+            self.run_stage('fill_addr_paths', self.fill_addr_paths)
+            self.run_stage('fill_zip_codes', self.fill_zip_codes)
+            self.run_stage('fill_zip_links', self.fill_zip_links)
+        else:
+            self.run_stage('load_address_objects', self.load_address_objects,
+                addrobj_fname, processes=processes)
+            self.run_stage('load_socr', self.load_socr, socr_fname)
+            if mode == 'regions':
+                # Поля и таблицы, зависящие от иерархии, заполняются
+                # по регионам
+                self.run_stage('fill_zip_codes', self.fill_zip_codes)
+                self.run_stage('fill_regions', self.fill_regions, processes=processes)
+            else:
+                self.run_stage('fill_parent_ids', self.fill_parent_ids)
+                self.run_stage('fill_addr_paths', self.fill_addr_paths)
+                self.run_stage('fill_zip_codes', self.fill_zip_codes)
+                self.run_stage('fill_zip_links', self.fill_zip_links)
+                self.run_stage('fill_addrobj_socr', self.fill_addrobj_socr)
+                self.run_stage('fill_good_names', self.fill_good_names, processes=processes)
+
+        # Вторичные индексы таблиц (если их создание было отложено)
+        self.run_stage('create_indexes', self.create_indexes)
+
+        # Файл индекса почтовых индексов
+        if index_dir is not None:
+            self.run_stage('write_zip_index', self.write_zip_index, index_dir)
+
+    def build_delta(self, prev_version, addrobj_fname, source='',
+            defer_indexes=True, index_dir=None, report_file=None, progress=None):
+        """Создаёт таблицы данной версии БД из таблиц предыдущей версии
+        и файла изменений адресных объектов ФИАС (см. apply_delta).
+
+        Аргументы те же, что и у build.
+        """
+        self._run_build(source, report_file, progress, self._build_delta,
+            prev_version, addrobj_fname, defer_indexes, index_dir)
+
+    def _build_delta(self, prev_version, addrobj_fname, defer_indexes, index_dir):
+        self.run_stage('create_tables', self.create_tables, defer_indexes=defer_indexes)
+        self.run_stage('copy_tables', self.copy_tables, prev_version)
+        # Индексы создаются до применения изменений: по ним удаляются
+        # устаревшие связи почтовых индексов (ZIPLINKS.ZIPID) и т.д.
+        self.run_stage('create_indexes', self.create_indexes)
+        self.run_stage('apply_delta', self.apply_delta, prev_version, addrobj_fname)
+        if index_dir is not None:
+            self.run_stage('write_zip_index', self.write_zip_index, index_dir)
+
+    def has_binary_guids(self, version):
+        """Проверяет, хранятся ли GUID'ы в таблице ADDROBJ версии БД
+        version в полях BINARY(16). Версии со строковыми GUID'ами
+        нельзя обновить по файлу изменений (нужна полная сборка)."""
+        cur = self.dbconn.cursor()
+        cur.execute("SHOW COLUMNS FROM addrobj_v%(version)s LIKE 'aoguid'" % {
+            'version': version
+        })
+        row = cur.fetchone()
+        cur.close()
+        self.dbconn.commit()
+        return row is not None and row[1].lower() == 'binary(16)'
+
+    def copy_tables(self, prev_version):
+        """Копирует данные таблиц предыдущей версии БД в таблицы данной
+        версии (ID записей сохраняются)."""
+        cur = self.dbconn.cursor()
+        for table in ('socrbase', 'addrobj', 'addrpaths', 'zipcodes', 'ziplinks'):
+            cur.execute('TRUNCATE TABLE %(table)s%(version_suffix)s' % {
+                'version_suffix': self.version_suffix,
+                'table': table,
+            })
+            cur.execute("""INSERT INTO %(table)s%(version_suffix)s
+                SELECT * FROM %(table)s_v%(prev_version)s""" % {
+                    'version_suffix': self.version_suffix,
+                    'table': table,
+                    'prev_version': prev_version,
+                })
+            self.dbconn.commit()
+            self._progress('Copying %s table.' % table.upper(), cur.rowcount)
+        cur.close()
+
+    def _read_delta_address_objects(self, fname):
+        """Читает файл изменений адресных объектов. Возвращает словарь:
+        GUID объекта -> строка для таблицы ADDROBJ (см. _addrobj_row)
+        или None, если объект больше не действует."""
+        changes = OrderedDict()
+        cnt = 0
+        for event, element in _iterparse(fname, events=('end',), tag='Object'):
+            aoguid = _guid_bytes(element.get('AOGUID'))
+            if _is_loaded(element, self.regions):
+                changes[aoguid] = _addrobj_row(element)
+            elif element.get('LIVESTATUS') == '1' or not element.get('NEXTID'):
+                # Запись не заменена новой записью, т.е. объект удалён
+                # (исторические записи с NEXTID пропускаются) или
+                # перенесён в регион, который не загружается
+                changes.setdefault(aoguid, None)
+
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+            cnt += 1
+            if cnt % 10000 == 0:
+                print("Reading ADDROBJ changes.", cnt)
+        return changes
+
+    def apply_delta(self, prev_version, fname, step=10000):
+        """Применяет файл изменений адресных объектов ФИАС к таблицам
+        данной версии БД (скопированным из предыдущей версии, см.
+        copy_tables).
+
+        Изменённые адресные объекты обновляются (их ID сохраняются),
+        новые добавляются, удалённые удаляются. Поля PARENTID, SOCRCODE
+        и DISPLAYNAME и таблицы ADDRPATHS, ZIPCODES и ZIPLINKS
+        пересчитываются только для изменённых объектов, их потомков
+        и затронутых почтовых индексов. Изменения определяются сравнением
+        с таблицами предыдущей версии, поэтому прерванный этап можно
+        выполнить повторно.
+        """
+        self._tune_session_for_bulk_load()
+
+        changes = self._read_delta_address_objects(fname)
+        print('Total changes: %i' % len(changes))
+
+        cur1 = self.dbconn.cursor(storage.SSCursor)
+        cur2 = self.dbconn.cursor()
+
+        # Почтовые индексы изменённых объектов в предыдущей версии
+        # (их связи с адресными объектами нужно пересчитать)
+        old_zips = set()
+        sql = """SELECT aoguid, postalcode FROM addrobj_v%(prev_version)s""" % {
+            'prev_version': prev_version
+        }
+        cur1.execute(sql)
+        for aoguid, postalcode in cur1:
+            if aoguid in changes and postalcode is not None:
+                old_zips.add(postalcode)
         cur1.close()
-        cur1 = self.dbconn.cursor(pymysql.cursors.DictCursor)
+
+        # ID адресных объектов по GUID'ам
+        guid_ids = {}
+        cur1 = self.dbconn.cursor(storage.SSCursor)
+        sql = """SELECT id, aoguid FROM addrobj%(version_suffix)s ORDER BY id""" % {
+            'version_suffix': self.version_suffix
+        }
         cur1.execute(sql)
-        for row in cur1:
-            row['version_suffix'] = self.version_suffix
+        for ao_id, aoguid in cur1:
+            guid_ids.setdefault(aoguid, ao_id)
+        cur1.close()
 
-            sql = """SELECT id FROM addrobj%(version_suffix)s
-                WHERE aoguid = '%(parentguid)s' LIMIT 1""" % row
-            cur2.execute(sql)
-            res = cur2.fetchone()
-            parent_id = res['id'] if res is not None else 0
+        # Изменённые и новые объекты
+        socr, socr_codes = self._get_socr()
+        sql = """INSERT INTO addrobj%(version_suffix)s (id, socrcode, displayname,
+                aoguid, formalname, offname,
+                postalcode, shortname,
+                aolevel, parentguid, regioncode)
+            VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)
+            ON DUPLICATE KEY UPDATE
+                socrcode = VALUES(socrcode),
+                displayname = VALUES(displayname),
+                formalname = VALUES(formalname),
+                offname = VALUES(offname),
+                postalcode = VALUES(postalcode),
+                shortname = VALUES(shortname),
+                aolevel = VALUES(aolevel),
+                parentguid = VALUES(parentguid),
+                regioncode = VALUES(regioncode)""" % {
+                'version_suffix': self.version_suffix
+            }
+        rows = [row for row in changes.values() if row is not None]
+        cnt_all = len(rows)
+        for start in range(0, cnt_all, step):
+            chunk = rows[start:start + step]
+            socrcodes = []
+            names_rows = []
+            for i, row in enumerate(chunk):
+                socrcode, names_row = _good_name_row(i, row, socr, socr_codes)
+                socrcodes.append(socrcode)
+                if names_row is not None:
+                    names_rows.append(names_row)
+            names = dict(_make_good_names(names_rows))
+
+            cur2.executemany(sql, [
+                (guid_ids.get(row[0]), socrcodes[i], names.get(i, '')) + row
+                for i, row in enumerate(chunk)
+            ])
+            self.dbconn.commit()
+            self._progress('Updating ADDROBJ table.', start + len(chunk), cnt_all)
+
+        # Удалённые объекты
+        deleted_ids = [guid_ids[aoguid] for aoguid, row in changes.items()
+            if row is None and aoguid in guid_ids]
+        for start in range(0, len(deleted_ids), step):
+            ids = ', '.join([str(ao_id) for ao_id in deleted_ids[start:start + step]])
+            for table, column in (('addrobj', 'id'), ('addrpaths', 'aoid')):
+                cur2.execute("""DELETE FROM %(table)s%(version_suffix)s
+                    WHERE %(column)s IN (%(ids)s)""" % {
+                        'version_suffix': self.version_suffix,
+                        'table': table,
+                        'column': column,
+                        'ids': ids,
+                    })
+            self.dbconn.commit()
+        print('Deleted from ADDROBJ table: %i' % len(deleted_ids))
+
+        # Пересчитываем PARENTID (записываются только изменившиеся значения).
+        # Сменившие родителя объекты определяются по PARENTID предыдущей
+        # версии: при повторном выполнении этапа PARENTID данной версии
+        # может быть уже записан
+        guid_ids = {}
+        objects = []
+        cur1 = self.dbconn.cursor(storage.SSCursor)
+        sql = """SELECT a.id, a.aoguid, a.parentguid, a.parentid, a.postalcode,
+                p.parentid
+            FROM addrobj%(version_suffix)s a
+                LEFT JOIN addrobj_v%(prev_version)s p ON p.id = a.id
+            ORDER BY a.id""" % {
+                'version_suffix': self.version_suffix,
+                'prev_version': prev_version,
+            }
+        cur1.execute(sql)
+        for row in cur1:
+            guid_ids.setdefault(row[1], row[0])
+            objects.append(row)
+        cur1.close()
 
-            row['parent_id'] = parent_id
+        # Соответствие ID адресных объектов ID их родителей
+        parents = {}
+        # Адресные объекты с данным почтовым индексом
+        zip_objects = {}
+        # Новые значения PARENTID
+        parent_ids = []
+        # Объекты, у которых изменился родитель по сравнению с предыдущей версией
+        moved = []
+        for ao_id, aoguid, parentguid, parent_id, postalcode, prev_parent_id in objects:
+            parents[ao_id] = guid_ids.get(parentguid, 0)
+            if parents[ao_id] != (parent_id or 0):
+                parent_ids.append((ao_id, parents[ao_id]))
+            if parents[ao_id] != (prev_parent_id or 0):
+                moved.append(ao_id)
+            if postalcode is not None and postalcode != 'None':
+                zip_objects.setdefault(postalcode, []).append(ao_id)
+        for start in range(0, len(parent_ids), step):
+            self._update_column(cur2, 'addrobj', 'parentid', parent_ids[start:start + step])
+            self.dbconn.commit()
+        print('Changed PARENTID in ADDROBJ table: %i' % len(parent_ids))
+
+        # Затронутые объекты: изменённые, сменившие родителя и все их потомки
+        children = {}
+        for ao_id, parent_id in parents.items():
+            children.setdefault(parent_id, []).append(ao_id)
+        affected = set()
+        queue = deque([guid_ids[aoguid] for aoguid, row in changes.items()
+            if row is not None and aoguid in guid_ids])
+        queue.extend(moved)
+        while len(queue) > 0:
+            ao_id = queue.popleft()
+            if ao_id in affected:
+                continue
+            affected.add(ao_id)
+            queue.extend(children.get(ao_id, []))
+        print('Affected address objects: %i' % len(affected))
+
+        # Пути к предкам затронутых объектов
+        sql = """INSERT INTO addrpaths%(version_suffix)s (aoid, ancestorid, depth)
+            VALUES (%%s, %%s, %%s)""" % {
+                'version_suffix': self.version_suffix
+            }
+        affected_ids = sorted(affected)
+        for start in range(0, len(affected_ids), step):
+            chunk = affected_ids[start:start + step]
+            cur2.execute("""DELETE FROM addrpaths%(version_suffix)s
+                WHERE aoid IN (%(ids)s)""" % {
+                    'version_suffix': self.version_suffix,
+                    'ids': ', '.join([str(ao_id) for ao_id in chunk]),
+                })
+            rows = []
+            for ao_id in chunk:
+                rows.extend(_addr_paths(ao_id, parents))
+            cur2.executemany(sql, rows)
+            self.dbconn.commit()
+            self._progress('Updating ADDRPATHS table.', start + len(chunk), len(affected_ids))
+
+        # Затронутые почтовые индексы: прежние индексы изменённых объектов
+        # и индексы затронутых объектов
+        affected_zips = set(old_zips)
+        for ao_id, aoguid, parentguid, parent_id, postalcode, prev_parent_id in objects:
+            if ao_id in affected and postalcode is not None and postalcode != 'None':
+                affected_zips.add(postalcode)
+
+        zip_ids = {}
+        cur1 = self.dbconn.cursor(storage.SSCursor)
+        cur1.execute("""SELECT id, zip FROM zipcodes%(version_suffix)s ORDER BY id""" % {
+            'version_suffix': self.version_suffix
+        })
+        for zip_id, zip_code in cur1:
+            zip_ids.setdefault(zip_code, zip_id)
+        cur1.close()
 
-            sql = """UPDATE addrobj%(version_suffix)s
-                SET parentid = %(parent_id)s
-                WHERE id = %(ao_id)s""" % row
-            cur2.execute(sql)
+        sql = """INSERT INTO ziplinks%(version_suffix)s (zipid, aoid)
+            VALUES (%%s, %%s)""" % {
+                'version_suffix': self.version_suffix
+            }
+        cnt = 0
+        for zip_code in sorted(affected_zips):
+            if zip_code in zip_ids:
+                cur2.execute("""DELETE FROM ziplinks%(version_suffix)s
+                    WHERE zipid = %(zip_id)s""" % {
+                        'version_suffix': self.version_suffix,
+                        'zip_id': zip_ids[zip_code],
+                    })
+            if zip_code not in zip_objects:
+                # Почтовый индекс больше не используется
+                if zip_code in zip_ids:
+                    cur2.execute("""DELETE FROM zipcodes%(version_suffix)s
+                        WHERE id = %(zip_id)s""" % {
+                            'version_suffix': self.version_suffix,
+                            'zip_id': zip_ids[zip_code],
+                        })
+            else:
+                if zip_code not in zip_ids:
+                    cur2.execute("""INSERT INTO zipcodes%(version_suffix)s (zip)
+                        VALUES (%%s)""" % {
+                            'version_suffix': self.version_suffix
+                        }, (zip_code,))
+                    zip_ids[zip_code] = cur2.lastrowid
+                cur2.executemany(sql, _zip_links(zip_ids[zip_code], zip_objects[zip_code], parents))
 
             cnt += 1
-            if cnt % 100 == 0:
-                print('Filling PARENTID field in ADDROBJ table. %s / %s' % (cnt, cnt_all))
+            if cnt % 1000 == 0:
+                self._progress('Updating ZIPLINKS table.', cnt, len(affected_zips))
                 self.dbconn.commit()
 
-        if cnt % 100 != 0:
-            print('Filling PARENTID field in ADDROBJ table. %s / %s' % (cnt, cnt_all))
-            self.dbconn.commit()
+        self._progress('Updating ZIPLINKS table.', cnt, len(affected_zips))
         self.dbconn.commit()
+        self.stage_rows = len(changes)
 
         cur2.close()
-        cur1.close()
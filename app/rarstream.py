@@ -0,0 +1,54 @@
+"""Чтение файлов из RAR-архива без распаковки на диск.
+
+Файл выводится утилитой unrar в stdout и разбирается по мере
+распаковки, поэтому распакованная копия на диске не создаётся.
+"""
+from contextlib import contextmanager
+import subprocess
+
+
+def list_files(rar_fname):
+    """Возвращает список имён файлов в архиве."""
+    output = subprocess.check_output(['unrar', 'lb', rar_fname])
+    return [line.decode('utf-8') for line in output.splitlines() if len(line) > 0]
+
+
+def find_file(rar_fname, prefix):
+    """Возвращает файл архива, имя которого начинается с prefix
+    (или None, если такого файла нет)."""
+    for name in list_files(rar_fname):
+        if name.startswith(prefix):
+            return RarMember(rar_fname, name)
+    return None
+
+
+class RarMember:
+    """Файл в RAR-архиве."""
+
+    def __init__(self, rar_fname, name, bufsize=1024*1024):
+        self.rar_fname = rar_fname
+        self.name = name
+        self.bufsize = bufsize
+
+    def __str__(self):
+        return '%s:%s' % (self.rar_fname, self.name)
+
+    @contextmanager
+    def open(self):
+        """Возвращает поток с содержимым файла."""
+        proc = subprocess.Popen(['unrar', 'p', '-inul', self.rar_fname, self.name],
+            stdout=subprocess.PIPE, bufsize=self.bufsize)
+        try:
+            yield proc.stdout
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+
+        # Дочитываем поток, чтобы unrar завершился без ошибки
+        while len(proc.stdout.read(self.bufsize)) > 0:
+            pass
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode,
+                'unrar p %s %s' % (self.rar_fname, self.name))
@@ -0,0 +1,324 @@
+"""Соединения с БД: MySQL (pymysql) или файл SQLite.
+
+Запросы сервиса и сборки версий БД написаны на диалекте MySQL
+и выполняются через соединения pymysql. Для SQLite модуль даёт
+соединение с тем же интерфейсом (cursor, commit, escape и т.д.),
+которое переводит используемые в проекте конструкции MySQL в SQLite:
+параметры %s, TRUNCATE, ON DUPLICATE KEY UPDATE, AUTO_INCREMENT
+и вторичные индексы в CREATE TABLE, ALTER TABLE ... ADD INDEX,
+SHOW INDEX/COLUMNS/STATUS, SET SESSION. Так версию БД можно собрать
+без сервера MySQL, а AddressOKGetter -- проверить на файле БД.
+
+Строковые поля таблиц SQLite создаются с collation utf8_general_ci,
+а LIKE заменяется функцией с тем же сравнением (упрощённый аналог
+collation MySQL: без учёта регистра, ё = е).
+
+Модуль pymysql нужен только для работы с MySQL.
+"""
+import binascii, functools, re, sqlite3
+import conf
+
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+
+if pymysql is not None:
+    DictCursor = pymysql.cursors.DictCursor
+    SSCursor = pymysql.cursors.SSCursor
+    Error = pymysql.err.Error
+    OperationalError = pymysql.err.OperationalError
+    ProgrammingError = pymysql.err.ProgrammingError
+else:
+    class DictCursor:
+        """Курсор, возвращающий строки в виде словарей."""
+
+    class SSCursor:
+        """Курсор, получающий строки по мере чтения."""
+
+    class Error(Exception):
+        pass
+
+    class OperationalError(Error):
+        pass
+
+    class ProgrammingError(Error):
+        pass
+
+# Код ошибки MySQL "Table doesn't exist"
+ER_NO_SUCH_TABLE = 1146
+# Коды ошибок MySQL "Lock wait timeout exceeded" и "Deadlock found
+# when trying to get lock"
+ER_LOCK_WAIT_TIMEOUT = 1205
+ER_LOCK_DEADLOCK = 1213
+
+
+def connect(**kwargs):
+    """Создаёт соединение с БД, заданной в conf (conf.db_engine).
+    Аргументы kwargs передаются pymysql.connect."""
+    if conf.db_engine == 'sqlite':
+        return connect_sqlite(conf.sqlite_file)
+    return pymysql.connect(host=conf.db_host, user=conf.db_user,
+        passwd=conf.db_password, db=conf.db_name, port=conf.db_port,
+        charset='utf8', **kwargs)
+
+
+def connect_sqlite(fname, timeout=60):
+    """Открывает (или создаёт) файл БД SQLite. timeout -- время
+    в секундах, в течение которого ожидается снятие блокировки,
+    установленной другим соединением."""
+    return SQLiteConnection(fname, timeout)
+
+
+# Строковая константа или параметр запроса
+_PARAM_RE = re.compile(r"('(?:[^'\\]|\\.|'')*')|%(s|%)")
+_LIKE_RE = re.compile(r"(\bLIKE\s+'(?:[^'\\]|\\.|'')*')", re.I)
+_AUTO_INCREMENT_RE = re.compile(r'\b(\w+)\s+(?:INTEGER|BIGINT)\s+NOT NULL\s+AUTO_INCREMENT', re.I)
+_INDEX_RE = re.compile(r',\s*INDEX\s+(\w+)\s*\(([\w, ]+)\)', re.I)
+_CREATE_TABLE_RE = re.compile(r'\s*CREATE TABLE (?:IF NOT EXISTS )?(\w+)', re.I)
+_ADD_INDEX_RE = re.compile(r'\s*ALTER TABLE (\w+) ADD INDEX (\w+) \(([\w, ]+)\)\s*$', re.I)
+_SHOW_INDEX_RE = re.compile(r"\s*SHOW INDEX FROM (\w+) WHERE Key_name = '(\w+)'\s*$", re.I)
+_SHOW_COLUMNS_RE = re.compile(r"\s*SHOW COLUMNS FROM (\w+) LIKE '(\w+)'\s*$", re.I)
+_SHOW_STATUS_RE = re.compile(r"\s*SHOW SESSION STATUS LIKE '(\w+)'\s*$", re.I)
+_UPSERT_RE = re.compile(r'\bON DUPLICATE KEY UPDATE\b(.*)$', re.I | re.S)
+_STRING_TYPE_RE = re.compile(r'\b(VARCHAR\(\d+\)|TEXT)(?=[\s,])', re.I)
+
+
+def _fold(value):
+    """Приводит строку к виду, в котором строки сравниваются без учёта
+    регистра и различия ё/е (как collation utf8_general_ci в MySQL,
+    см. также engine._sort_key)."""
+    return value.lower().replace('ё', 'е')
+
+
+def _general_ci(a, b):
+    """Сравнивает строки (collation utf8_general_ci)."""
+    a = _fold(a)
+    b = _fold(b)
+    return (a > b) - (a < b)
+
+
+@functools.lru_cache(maxsize=1024)
+def _like_regex(pattern, escape):
+    """Переводит шаблон LIKE в регулярное выражение."""
+    parts = []
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == escape and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        elif ch == '%':
+            parts.append('.*')
+        elif ch == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(ch))
+        i += 1
+    return re.compile(''.join(parts) + r'\Z', re.S)
+
+
+def _like(pattern, value, escape=None):
+    """Функция SQLite like(шаблон, значение[, экранирующий символ]),
+    сравнивающая строки без учёта регистра всех букв (встроенный LIKE
+    не учитывает регистр только латинских букв)."""
+    if pattern is None or value is None:
+        return None
+    return _like_regex(_fold(str(pattern)), escape).match(_fold(str(value))) is not None
+
+
+def _index_name(table, key_name):
+    # Имена индексов в SQLite уникальны в пределах БД
+    return '%s_%s' % (table, key_name)
+
+
+def _convert_params(sql):
+    """Заменяет параметры %s на ? и %% на % (вне строковых констант)."""
+    def replace(match):
+        if match.group(1) is not None:
+            return match.group(1)
+        return '?' if match.group(2) == 's' else '%'
+    return _PARAM_RE.sub(replace, sql)
+
+
+def _convert_create_table(sql):
+    """Переводит CREATE TABLE в SQLite. Возвращает запросы: создание
+    таблицы и её вторичных индексов."""
+    table = _CREATE_TABLE_RE.match(sql).group(1)
+    match = _AUTO_INCREMENT_RE.search(sql)
+    if match is not None:
+        column = match.group(1)
+        sql = sql[:match.start()] + '%s INTEGER PRIMARY KEY' % column + sql[match.end():]
+        sql = re.sub(r',\s*PRIMARY KEY\s*\(%s\)' % column, '', sql, flags=re.I)
+    sql = _STRING_TYPE_RE.sub(r'\1 COLLATE utf8_general_ci', sql)
+    indexes = _INDEX_RE.findall(sql)
+    sql = _INDEX_RE.sub('', sql)
+    return [sql] + ['CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (_index_name(table, key_name),
+        table, columns) for key_name, columns in indexes]
+
+
+def _convert(sql, has_params):
+    """Переводит запрос MySQL в запросы SQLite. Возвращает список пар
+    (запрос, параметры или None -- параметры самого запроса)."""
+    match = _SHOW_INDEX_RE.match(sql)
+    if match is not None:
+        table, key_name = match.groups()
+        return [("""SELECT tbl_name, name FROM sqlite_master
+            WHERE type = 'index' AND tbl_name = ? AND name = ?""",
+            (table, _index_name(table, key_name)))]
+    match = _SHOW_COLUMNS_RE.match(sql)
+    if match is not None:
+        return [("SELECT name, type FROM pragma_table_info(?) WHERE name = ?", match.groups())]
+    match = _ADD_INDEX_RE.match(sql)
+    if match is not None:
+        table, key_name, columns = match.groups()
+        return [('CREATE INDEX %s ON %s (%s)' % (_index_name(table, key_name), table, columns), ())]
+    if re.match(r'\s*SET SESSION\b', sql, re.I):
+        return []
+
+    if has_params:
+        sql = _convert_params(sql)
+    if _CREATE_TABLE_RE.match(sql):
+        return [(query, None) for query in _convert_create_table(sql)]
+
+    sql = re.sub(r'^\s*TRUNCATE TABLE\b', 'DELETE FROM', sql, flags=re.I)
+    sql = re.sub(r'\bNOW\(\)', 'CURRENT_TIMESTAMP', sql, flags=re.I)
+    sql = _LIKE_RE.sub(r"\1 ESCAPE '\\'", sql)
+    match = _UPSERT_RE.search(sql)
+    if match is not None:
+        updates = re.sub(r'\bVALUES\((\w+)\)', r'excluded.\1', match.group(1), flags=re.I)
+        sql = sql[:match.start()] + 'ON CONFLICT DO UPDATE SET' + updates
+    return [(sql, None)]
+
+
+class SQLiteCursor:
+    """Курсор SQLite с интерфейсом курсора pymysql."""
+
+    def __init__(self, connection, cursorclass=None):
+        self.connection = connection
+        self.cursor = connection.conn.cursor()
+        # Строки возвращаются в виде словарей
+        self.as_dict = cursorclass is not None and issubclass(cursorclass, DictCursor)
+        self.rowcount = -1
+        self.lastrowid = None
+        # Результат эмулируемого запроса (SHOW SESSION STATUS)
+        self.rows = None
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def _run(self, func, sql, params):
+        try:
+            func(sql, params)
+        except sqlite3.OperationalError as err:
+            if str(err).startswith('no such table'):
+                raise ProgrammingError(ER_NO_SUCH_TABLE, str(err))
+            raise OperationalError(0, str(err))
+        self.rowcount = self.cursor.rowcount
+        self.lastrowid = self.cursor.lastrowid
+
+    def execute(self, query, args=None):
+        """Выполняет запрос MySQL (см. _convert). Параметры args
+        подставляются вместо %s."""
+        self.rows = None
+        self.connection.statements += 1
+        match = _SHOW_STATUS_RE.match(query)
+        if match is not None:
+            # Есть только счётчик запросов (Questions)
+            self.rows = [(match.group(1), self.connection.statements)]
+            return len(self.rows)
+
+        for sql, params in _convert(query, args is not None):
+            if params is None:
+                params = tuple(args) if args is not None else ()
+            self._run(self.cursor.execute, sql, params)
+        return self.rowcount
+
+    def executemany(self, query, args):
+        """Выполняет запрос для каждого набора параметров из args."""
+        self.rows = None
+        self.connection.statements += 1
+        for sql, params in _convert(query, True):
+            self._run(self.cursor.executemany, sql, (tuple(row) for row in args))
+        return self.rowcount
+
+    def _make_row(self, row):
+        if row is None or not self.as_dict:
+            return row
+        return dict(zip([column[0] for column in self.cursor.description], row))
+
+    def fetchone(self):
+        if self.rows is not None:
+            return self.rows.pop(0) if len(self.rows) > 0 else None
+        return self._make_row(self.cursor.fetchone())
+
+    def fetchmany(self, size=None):
+        if self.rows is not None:
+            rows, self.rows = self.rows, []
+            return rows
+        size = size if size is not None else self.cursor.arraysize
+        return [self._make_row(row) for row in self.cursor.fetchmany(size)]
+
+    def fetchall(self):
+        if self.rows is not None:
+            rows, self.rows = self.rows, []
+            return rows
+        return [self._make_row(row) for row in self.cursor.fetchall()]
+
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection:
+    """Соединение с файлом БД SQLite с интерфейсом соединения pymysql."""
+
+    def __init__(self, fname, timeout=60):
+        self.fname = fname
+        # Соединение может выдаваться разным потокам (см. dbpool),
+        # но одновременно используется одним потоком
+        try:
+            self.conn = sqlite3.connect(fname, timeout=timeout, check_same_thread=False)
+            # Читатели не блокируются записью
+            self.conn.execute('PRAGMA journal_mode = WAL')
+            self.conn.execute('PRAGMA synchronous = NORMAL')
+            self.conn.create_collation('utf8_general_ci', _general_ci)
+            self.conn.create_function('like', 2, _like)
+            self.conn.create_function('like', 3, _like)
+        except sqlite3.OperationalError as err:
+            raise OperationalError(0, str(err))
+        # Кол-во выполненных запросов (см. SHOW SESSION STATUS)
+        self.statements = 0
+
+    def cursor(self, cursorclass=None):
+        return SQLiteCursor(self, cursorclass)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def ping(self, reconnect=False):
+        self.conn.execute('SELECT 1')
+
+    def close(self):
+        self.conn.close()
+
+    def escape(self, value):
+        """Возвращает значение в виде константы SQL."""
+        if value is None:
+            return 'NULL'
+        if isinstance(value, bool):
+            return str(int(value))
+        if isinstance(value, (int, float)):
+            return repr(value)
+        if isinstance(value, bytes):
+            return "X'%s'" % binascii.hexlify(value).decode('ascii')
+        return "'%s'" % str(value).replace("'", "''")
@@ -0,0 +1,193 @@
+"""Сборка версии БД в файл SQLite и сравнение ответов AddressOKGetter
+(запросы к БД) и AddressOKEngine (ответы из памяти); сборка версии
+по файлу изменений, в том числе с прерванным этапом apply_delta.
+
+Запуск из папки app: python3 -m unittest test_sqlite
+"""
+import io, os, shutil, tempfile, unittest
+from contextlib import redirect_stdout
+from unittest import mock
+import initializer
+import getter
+import engine
+import storage
+
+SOCRBASE = [
+    (1, 'Респ', 'Республика', '106'),
+    (3, 'р-н', 'Район', '301'),
+    (4, 'г', 'Город', '401'),
+    (6, 'с', 'Село', '630'),
+    (7, 'ул', 'Улица', '729'),
+    (7, 'пер', 'Переулок', '714'),
+]
+
+# GUID, родитель, наименование, сокращение, уровень, почтовый индекс
+ADDROBJ = [
+    (1, None, 'Татарстан', 'Респ', 1, None),
+    (2, 1, 'Казань', 'г', 4, '420000'),
+    (3, 2, 'Ленина', 'ул', 7, '420001'),
+    (4, 2, 'Лесная', 'ул', 7, '420001'),
+    (5, 2, 'Ёлочный', 'пер', 7, '420002'),
+    (6, 2, 'Садовая', 'ул', 7, '420002'),
+    (7, 1, 'Лаишевский', 'р-н', 3, '422600'),
+    (8, 7, 'Столбище', 'с', 6, '422624'),
+    (9, 8, 'Кооперативная', 'ул', 7, '422624'),
+    (10, 8, 'елочная', 'ул', 7, '422624'),
+]
+
+# Изменения: город удалён (его улицы остались без родителя),
+# улица переименована, добавлена новая улица
+DELTA = [
+    (2, 1, 'Казань', 'г', 4, '420000', '0'),
+    (4, 2, 'Лесная', 'ул', 7, '420003', '1'),
+    (11, 8, 'Новая', 'ул', 7, '422624', '1'),
+]
+
+
+def _guid(num):
+    return '00000000-0000-0000-0000-%012d' % num
+
+
+def _write_addrobj(fname, objects):
+    with open(fname, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?><AddressObjects>')
+        for num, parent, name, short, level, zip_code, live in objects:
+            f.write('<Object AOGUID="%s" FORMALNAME="%s" OFFNAME="%s" SHORTNAME="%s"'
+                ' AOLEVEL="%s" REGIONCODE="16" LIVESTATUS="%s" ACTSTATUS="%s"' % (
+                    _guid(num), name, name, short, level, live, live))
+            if parent is not None:
+                f.write(' PARENTGUID="%s"' % _guid(parent))
+            if zip_code is not None:
+                f.write(' POSTALCODE="%s"' % zip_code)
+            f.write(' />')
+        f.write('</AddressObjects>')
+
+
+def _write_sources(dirname):
+    addrobj_fname = os.path.join(dirname, 'AS_ADDROBJ_TEST.XML')
+    _write_addrobj(addrobj_fname, [row + ('1',) for row in ADDROBJ])
+
+    socr_fname = os.path.join(dirname, 'AS_SOCRBASE_TEST.XML')
+    with open(socr_fname, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?><AddressObjectTypes>')
+        for level, scname, socrname, kod_t_st in SOCRBASE:
+            f.write('<AddressObjectType LEVEL="%s" SCNAME="%s" SOCRNAME="%s" KOD_T_ST="%s" />'
+                % (level, scname, socrname, kod_t_st))
+        f.write('</AddressObjectTypes>')
+
+    return addrobj_fname, socr_fname
+
+
+class SQLiteBuildTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dirname = tempfile.mkdtemp()
+        addrobj_fname, socr_fname = _write_sources(cls.dirname)
+        cls.dbconn = storage.connect_sqlite(os.path.join(cls.dirname, 'test.sqlite'))
+        init = initializer.AddressOKInitializer(cls.dbconn, 1)
+        with redirect_stdout(io.StringIO()):
+            init.build(addrobj_fname, socr_fname, processes=1)
+        cls.getter = getter.AddressOKGetter(cls.dbconn, 1)
+        cls.engine = engine.AddressOKEngine(cls.dbconn, 1)
+
+        cur = cls.dbconn.cursor()
+        cur.execute('SELECT id FROM addrobj_v1 ORDER BY id')
+        cls.ids = [row[0] for row in cur.fetchall()]
+        cur.execute('SELECT zip FROM zipcodes_v1 ORDER BY zip')
+        cls.zip_codes = [row[0] for row in cur.fetchall()]
+        cur.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dbconn.close()
+        shutil.rmtree(cls.dirname)
+
+    def test_tables(self):
+        self.assertEqual(len(self.ids), len(ADDROBJ))
+        self.assertEqual(self.zip_codes, ['420000', '420001', '420002', '422600', '422624'])
+        self.assertEqual(self.getter.get_initial_addr_objects()['suggest']['region'],
+            [{'value': self.ids[0], 'label': 'Республика Татарстан'}])
+
+    def test_addr_objects(self):
+        for ao_id in [0] + self.ids:
+            for zip_code in [''] + self.zip_codes:
+                self.assertEqual(self.getter.get_addr_objects(ao_id, zip_code),
+                    self.engine.get_addr_objects(ao_id, zip_code))
+
+    def test_addr_objects_by_zip_code(self):
+        for zip_code in self.zip_codes + ['999999']:
+            self.assertEqual(self.getter.get_addr_objects_by_zip_code(zip_code),
+                self.engine.get_addr_objects_by_zip_code(zip_code))
+
+    def test_search(self):
+        city_id = self.ids[1]
+        for prefix in ['', 'л', 'Л', 'ле', 'ЛЕН', 'ел', 'ёл', 'с%', 'x']:
+            self.assertEqual(self.getter.search_addr_objects(city_id, 'street', prefix, 10),
+                self.engine.search_addr_objects(city_id, 'street', prefix, 10))
+        self.assertEqual(len(self.getter.search_addr_objects(city_id, 'street', 'л', 10)['suggest']), 2)
+        self.assertEqual(len(self.getter.search_addr_objects(city_id, 'street', 'ел', 10)['suggest']), 1)
+
+
+class SQLiteDeltaTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dirname = tempfile.mkdtemp()
+        addrobj_fname, socr_fname = _write_sources(cls.dirname)
+        cls.delta_fname = os.path.join(cls.dirname, 'AS_ADDROBJ_DELTA.XML')
+        _write_addrobj(cls.delta_fname, DELTA)
+        cls.dbconn = storage.connect_sqlite(os.path.join(cls.dirname, 'test.sqlite'))
+        init = initializer.AddressOKInitializer(cls.dbconn, 1)
+        with redirect_stdout(io.StringIO()):
+            init.build(addrobj_fname, socr_fname, processes=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dbconn.close()
+        shutil.rmtree(cls.dirname)
+
+    def _build_delta(self, version_num):
+        init = initializer.AddressOKInitializer(self.dbconn, version_num)
+        with redirect_stdout(io.StringIO()):
+            init.build_delta(1, self.delta_fname, source='delta')
+
+    def _select(self, sql, version_num):
+        cur = self.dbconn.cursor()
+        cur.execute(sql % {'version': version_num})
+        rows = cur.fetchall()
+        cur.close()
+        return rows
+
+    def _tables(self, version_num):
+        return [
+            self._select('SELECT id, parentid, displayname FROM addrobj_v%(version)s ORDER BY id',
+                version_num),
+            self._select('SELECT aoid, ancestorid, depth FROM addrpaths_v%(version)s'
+                ' ORDER BY aoid, ancestorid', version_num),
+            self._select('SELECT z.zip, l.aoid FROM ziplinks_v%(version)s l'
+                ' JOIN zipcodes_v%(version)s z ON z.id = l.zipid ORDER BY z.zip, l.aoid',
+                version_num),
+        ]
+
+    def test_resume_apply_delta(self):
+        self._build_delta(2)
+
+        # Этап прерывается после записи PARENTID и продолжается заново
+        with mock.patch('initializer._addr_paths', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self._build_delta(3)
+        self.dbconn.rollback()
+        self._build_delta(3)
+
+        tables = self._tables(2)
+        self.assertEqual(self._tables(3), tables)
+        addrobj, addrpaths, ziplinks = tables
+        self.assertNotIn(2, [row[0] for row in addrobj])
+        self.assertNotIn(2, [row[1] for row in addrpaths])
+        self.assertNotIn(2, [row[1] for row in ziplinks])
+        self.assertIn(('420003', 4), ziplinks)
+
+
+if __name__ == '__main__':
+    unittest.main()
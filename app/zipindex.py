@@ -0,0 +1,185 @@
+"""Бинарный индекс почтовых индексов.
+
+Для каждого почтового индекса в файле хранятся уже сгруппированные
+по полям формы (регион, район, населённый пункт, улица) ID и
+отображаемые имена адресных объектов. Файл открывается через mmap,
+поэтому все процессы сервиса используют одну копию данных в кэше
+страниц ОС, а открытие файла не требует его чтения.
+
+Формат файла (все числа little-endian):
+    заголовок: MAGIC, кол-во почтовых индексов N (uint32);
+    N почтовых индексов по ZIP_SIZE байт (ASCII, по возрастанию);
+    N смещений записей от начала файла (uint64);
+    записи: для каждого поля формы кол-во объектов (uint32), затем
+    для каждого объекта ID (int64), длина имени в байтах (uint16)
+    и имя в UTF-8.
+"""
+import mmap, os, shutil, struct
+
+MAGIC = b'AOKZIP01'
+ZIP_SIZE = 6
+
+# Поля формы в порядке записи
+FIELDS = ('region', 'district', 'place', 'street')
+# Уровни адресных объектов, соответствующие полям формы
+AOLEVELS = {1: 'region', 3: 'district', 4: 'place', 6: 'place', 7: 'street'}
+
+_count = struct.Struct('<I')
+_offset = struct.Struct('<Q')
+_item = struct.Struct('<qH')
+
+
+def index_file_name(index_dir, version):
+    """Возвращает имя файла индекса для версии БД."""
+    return os.path.join(index_dir, 'zipindex_v%s.bin' % version)
+
+
+def _zip_key(zip_code):
+    return zip_code.encode('ascii', 'replace')[:ZIP_SIZE].ljust(ZIP_SIZE)
+
+
+def _pack_record(groups):
+    data = []
+    for field in FIELDS:
+        items = groups.get(field, [])
+        data.append(_count.pack(len(items)))
+        for ao_id, label in items:
+            label = label.encode('utf-8')
+            data.append(_item.pack(ao_id, len(label)))
+            data.append(label)
+    return b''.join(data)
+
+
+def write_zip_index(fname, rows):
+    """Записывает файл индекса.
+
+    Аргументы:
+        rows: строки (zip, aolevel, id, displayname), упорядоченные по
+            почтовому индексу, уровню и наименованию объекта.
+    """
+    data_fname = fname+'.data'
+    zip_codes = []
+    offsets = []
+
+    with open(data_fname, 'wb') as data_file:
+        cur_zip = None
+        groups = {}
+        for zip_code, aolevel, ao_id, displayname in rows:
+            if aolevel not in AOLEVELS:
+                continue
+            if zip_code != cur_zip:
+                if cur_zip is not None:
+                    offsets.append(data_file.tell())
+                    data_file.write(_pack_record(groups))
+                    zip_codes.append(cur_zip)
+                cur_zip = zip_code
+                groups = {}
+            groups.setdefault(AOLEVELS[aolevel], []).append((ao_id, displayname or ''))
+        if cur_zip is not None:
+            offsets.append(data_file.tell())
+            data_file.write(_pack_record(groups))
+            zip_codes.append(cur_zip)
+
+    # Почтовые индексы в файле должны быть упорядочены побайтово
+    order = sorted(range(len(zip_codes)), key=lambda i: _zip_key(zip_codes[i]))
+    header_size = len(MAGIC) + _count.size + len(zip_codes) * ZIP_SIZE \
+        + len(zip_codes) * _offset.size
+
+    tmp_fname = fname+'.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_count.pack(len(zip_codes)))
+        for i in order:
+            f.write(_zip_key(zip_codes[i]))
+        for i in order:
+            f.write(_offset.pack(header_size + offsets[i]))
+        with open(data_fname, 'rb') as data_file:
+            shutil.copyfileobj(data_file, f)
+
+    os.remove(data_fname)
+    os.rename(tmp_fname, fname)
+    return len(zip_codes)
+
+
+class ZipIndex:
+    """Файл индекса почтовых индексов, открытый через mmap."""
+
+    def __init__(self, fname, version=None):
+        self.version = version
+        with open(fname, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError('Wrong zip index file: %s' % fname)
+        self.count = _count.unpack_from(self.data, len(MAGIC))[0]
+        self.zips_start = len(MAGIC) + _count.size
+        self.offsets_start = self.zips_start + self.count * ZIP_SIZE
+
+    def _zip_at(self, i):
+        start = self.zips_start + i * ZIP_SIZE
+        return self.data[start:start + ZIP_SIZE]
+
+    def _find(self, zip_code):
+        """Возвращает смещение записи для почтового индекса
+        (или None, если его нет в индексе)."""
+        key = _zip_key(zip_code)
+        lo, hi = 0, self.count
+        while lo < hi:
+            middle = (lo + hi) // 2
+            if self._zip_at(middle) < key:
+                lo = middle + 1
+            else:
+                hi = middle
+        if lo >= self.count or self._zip_at(lo) != key:
+            return None
+        return _offset.unpack_from(self.data, self.offsets_start + lo * _offset.size)[0]
+
+    def get_addr_objects_by_zip_code(self, zip_code):
+        """Возвращает адресную информацию по почтовому индексу
+        (в том же виде, что и AddressOKGetter)."""
+        res = {
+            'fill': {
+                'zip': zip_code,
+                'region': {'label': '', 'value': 0},
+                'district': {'label': '', 'value': 0},
+                'place': {'label': '', 'value': 0},
+                'street': {'label': '', 'value': 0},
+            },
+            'suggest': {
+                'region': [],
+                'district': [],
+                'place': [],
+                'street': [],
+            }
+        }
+
+        # Ключи индекса -- ровно ZIP_SIZE символов ASCII, другие
+        # почтовые индексы в файле не ищутся (их нет и в БД)
+        try:
+            key_size = len(zip_code.encode('ascii'))
+        except UnicodeEncodeError:
+            return res
+        if key_size != ZIP_SIZE:
+            return res
+
+        pos = self._find(zip_code)
+        if pos is None:
+            return res
+
+        for field in FIELDS:
+            cnt = _count.unpack_from(self.data, pos)[0]
+            pos += _count.size
+            for i in range(cnt):
+                ao_id, size = _item.unpack_from(self.data, pos)
+                pos += _item.size
+                label = self.data[pos:pos + size].decode('utf-8')
+                pos += size
+                res['suggest'][field].append({'value': ao_id, 'label': label})
+
+        for key, items in res['suggest'].items():
+            if len(items) == 1:
+                res['fill'][key] = res['suggest'][key][0]
+                res['suggest'][key] = []
+        return res
+
+    def close(self):
+        self.data.close()